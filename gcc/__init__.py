@@ -1,7 +1,5 @@
 import sys
 
-import gdb
-
 
 setup_done = False
 init_done = False
@@ -13,6 +11,12 @@ def setup():
         return
     setup_done = True
 
+    import gdb
+
+    # Connect cache invalidation first so that caches are flushed before the
+    # wrappers below get a chance to use them.
+    import gcc.cache
+    gcc.cache.connect_events()
     gdb.events.new_objfile.connect(handle_new_objfile)
 
 
@@ -23,19 +27,25 @@ def handle_new_objfile(event):
     ):
         return
 
+    import gcc.cache
     import gcc.cfg
-    from gcc.cfg import BasicBlock, BasicBlockPrinter, Edge, EdgePrinter
+    from gcc.cfg import (
+        BasicBlock, BasicBlockPrinter, DumpDotCommand, Edge, EdgePrinter
+    )
     from gcc.commands import Pregset
-    from gcc.die import Attribute, DIE, DIEPrinter
+    from gcc.die import Attribute, DIE, DIEPrinter, DIESnapshotCommand
     import gcc.ira
     from gcc.ira import (
-        IRAAllocno, IRAAllocnoPrinter, IRAObject, IRAMove, IRAMovePrinter,
-        IRALoopTreeNode
+        BucketCommand, ConflictGraphCommand, IRAAllocno, IRAAllocnoPrinter,
+        IRAObject, IRAMove, IRAMovePrinter, IRALoopTreeNode
     )
-    from gcc.matchers import MatchTree
+    from gcc.matchers import FindTree, FindTreeCommand, MatchTree
     from gcc.printers import GDBPrettyPrinters, LocationPrinter
-    from gcc.tracers import LocationDescriptionTracer
-    from gcc.tree import TreePrinter, Tree
+    from gcc.tracers import (
+        LocationDescriptionTracer, TraceBufferCommand, TraceCommand,
+        TraceSinkCommand
+    )
+    from gcc.tree import DumpTreeCommand, TreePrinter, Tree
     import gcc.utils
 
     value_wrappers = [
@@ -48,11 +58,22 @@ def handle_new_objfile(event):
     global init_done
     if not init_done:
         Pregset()
+        DumpDotCommand()
+        ConflictGraphCommand()
+        BucketCommand()
+        DIESnapshotCommand()
         MatchTree()
+        FindTree()
+        FindTreeCommand()
+        DumpTreeCommand()
         LocationDescriptionTracer()
+        TraceCommand()
+        TraceSinkCommand()
+        TraceBufferCommand()
         for w in value_wrappers:
             setattr(sys.modules['__main__'], w.__name__, w)
         sys.modules['__main__'].fmt_list = gcc.utils.fmt_list
+        sys.modules['__main__'].cache = gcc.cache
         sys.modules['__main__'].cfg = gcc.cfg
         sys.modules['__main__'].ira = gcc.ira
         init_done = True
@@ -0,0 +1,207 @@
+import weakref
+
+import gdb
+
+
+class CacheStats(object):
+    """Hit/miss counters for one cache."""
+
+    def __init__(self, name):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+
+    def reset(self):
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def __repr__(self):
+        return '<CacheStats {}: {} hits, {} misses ({:.1%})>'.format(
+            self.name, self.hits, self.misses, self.hit_rate
+        )
+
+
+_all_stats = {}
+
+
+def get_stats(name):
+    """Return the CacheStats instance for the cache called `name`."""
+    try:
+        return _all_stats[name]
+    except KeyError:
+        result = CacheStats(name)
+        _all_stats[name] = result
+        return result
+
+
+def stats():
+    """Return the list of counters for all caches."""
+    return [_all_stats[name] for name in sorted(_all_stats)]
+
+
+def reset_stats():
+    for s in _all_stats.values():
+        s.reset()
+
+
+def _objfile_key(progspace=None):
+    progspace = progspace or gdb.current_progspace()
+    return progspace.filename if progspace else None
+
+
+class ObjfileCache(object):
+    """
+    Mapping lazily populated with `compute(key)` results.
+
+    Entries are kept separately for each program (i.e. for each main objfile)
+    and are dropped as soon as objfiles are loaded or cleared for it: this is
+    meant for things that cannot change as long as debug info stays the same
+    (types, symbols, field offsets, constant tables, ...).
+    """
+
+    def __init__(self, name, compute):
+        self.name = name
+        self.compute = compute
+        self.stats = get_stats(name)
+        self.entries = {}
+        _objfile_caches.append(self)
+
+    def __getitem__(self, key):
+        entries = self.entries.setdefault(_objfile_key(), {})
+        try:
+            result = entries[key]
+        except KeyError:
+            self.stats.misses += 1
+            result = self.compute(key)
+            entries[key] = result
+        else:
+            self.stats.hits += 1
+        return result
+
+    def clear(self, objfile_key=None):
+        if objfile_key is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(objfile_key, None)
+
+
+_objfile_caches = []
+
+
+types = ObjfileCache('types', gdb.lookup_type)
+symbols = ObjfileCache('symbols', gdb.lookup_global_symbol)
+
+
+def lookup_type(name):
+    """Cached equivalent for `gdb.lookup_type(name)`."""
+    return types[name]
+
+
+def lookup_global_symbol(name):
+    """Cached equivalent for `gdb.lookup_global_symbol(name)`."""
+    return symbols[name]
+
+
+class StopCache(object):
+    """
+    Mapping for data read from the inferior state (memory, registers, ...).
+
+    It is flushed every time this state can change: when the inferior stops
+    or resumes, when the user modifies memory and after inferior function
+    calls. If `compute` is provided, missing entries are computed with
+    `compute(key)`.
+
+    If `weak` is true, entries are only kept as long as they are referenced
+    elsewhere, so that the cache size is bounded by what is still in use.
+    """
+
+    def __init__(self, name, compute=None, weak=False):
+        self.name = name
+        self.compute = compute
+        self.stats = get_stats(name)
+        self.entries = weakref.WeakValueDictionary() if weak else {}
+        _stop_caches.append(self)
+
+    def __getitem__(self, key):
+        try:
+            result = self.entries[key]
+        except KeyError:
+            if self.compute is None:
+                raise
+            self.stats.misses += 1
+            result = self.compute(key)
+            self.entries[key] = result
+        else:
+            self.stats.hits += 1
+        return result
+
+    def get(self, key, default=None):
+        try:
+            result = self.entries[key]
+        except KeyError:
+            self.stats.misses += 1
+            return default
+        else:
+            self.stats.hits += 1
+            return result
+
+    def __setitem__(self, key, value):
+        self.entries[key] = value
+
+    def clear(self):
+        self.entries.clear()
+
+
+_stop_caches = []
+_generation = 0
+
+
+def generation():
+    """
+    Return the current inferior state generation, an integer incremented
+    each time stop caches are flushed. Objects that cache data on their own
+    can compare it to a saved value to know whether the cache is still
+    valid.
+    """
+    return _generation
+
+
+def clear_stop_caches(event=None):
+    global _generation
+    _generation += 1
+    for c in _stop_caches:
+        c.clear()
+
+
+def clear_objfile_caches(objfile_key=None):
+    for c in _objfile_caches:
+        c.clear(objfile_key)
+
+
+def handle_new_objfile(event):
+    # Types can be resolved from any objfile, so loading a new one can change
+    # the result of a lookup: flush everything for the corresponding program.
+    clear_objfile_caches(_objfile_key(event.new_objfile.progspace))
+    clear_stop_caches()
+
+
+def handle_clear_objfiles(event):
+    clear_objfile_caches(_objfile_key(event.progspace))
+    clear_stop_caches()
+
+
+def connect_events():
+    gdb.events.new_objfile.connect(handle_new_objfile)
+    gdb.events.clear_objfiles.connect(handle_clear_objfiles)
+
+    # "cont" is also emitted when GDB resumes the inferior internally (for
+    # instance after a breakpoint condition evaluated to false), so that
+    # caches never survive a change in the inferior state.
+    for event in (gdb.events.stop, gdb.events.cont, gdb.events.exited,
+                  gdb.events.memory_changed, gdb.events.inferior_call_post):
+        event.connect(clear_stop_caches)
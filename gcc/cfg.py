@@ -1,16 +1,25 @@
+from array import array
 import os.path
+import struct
 import subprocess
+import tempfile
+import threading
 
 import gdb
 import gdb.types
 
-from gcc.utils import ptr_to_int
+from gcc.cache import ObjfileCache, StopCache, lookup_type
+from gcc.utils import (
+    field_offset, int_format, is_string, iter_pointer_chain, lookup_enum,
+    pointer_size, ptr_to_int, read_vec_pointers, type_field_offset,
+    unpack_pointer
+)
 
 
 class BasicBlock(object):
 
     def __init__(self, value):
-        if isinstance(value, basestring):
+        if is_string(value):
             value = gdb.parse_and_eval(value)
 
         if not isinstance(value, gdb.Value):
@@ -23,21 +32,13 @@ class BasicBlock(object):
 
         self.value = value
 
-    def _edge_vec_to_list(self, vec):
-        if not vec:
-            return []
-        return [
-            Edge(vec['m_vecdata'][i])
-            for i in range(int(vec['m_vecpfx']['m_num']))
-        ]
-
     @property
     def preds(self):
-        return self._edge_vec_to_list(self.value['preds'])
+        return EdgeList(self.value['preds'])
 
     @property
     def succs(self):
-        return self._edge_vec_to_list(self.value['succs'])
+        return EdgeList(self.value['succs'])
 
     @property
     def index(self):
@@ -60,7 +61,7 @@ class BasicBlock(object):
 class Edge(object):
 
     def __init__(self, value):
-        if isinstance(value, basestring):
+        if is_string(value):
             value = gdb.parse_and_eval(value)
 
         if not isinstance(value, gdb.Value):
@@ -72,6 +73,7 @@ class Edge(object):
             raise ValueError('Invalid edge: {}'.format(valtyp))
 
         self.value = value
+        self.info = None
 
     @property
     def source(self):
@@ -83,17 +85,151 @@ class Edge(object):
 
     def __repr__(self):
         addr = ptr_to_int(self.value)
-        if addr:
-            return '<Edge from BB {} to BB {}>'.format(self.source.index,
-                                                       self.destination.index)
-        else:
+        if not addr:
             return 'nullptr'
+        elif self.info is not None:
+            src_index, dest_index = self.info.src_index, self.info.dest_index
+        else:
+            src_index = self.source.index
+            dest_index = self.destination.index
+        return '<Edge from BB {} to BB {}>'.format(src_index, dest_index)
+
+
+class EdgeLayout(object):
+    """
+    Offsets and sizes needed to decode `edge_def` structures from raw memory.
+    """
+
+    def __init__(self):
+        edge_type = lookup_type('edge').target().strip_typedefs()
+        self.size = edge_type.sizeof
+        self.src_offset = type_field_offset(edge_type, 'src')
+        self.dest_offset = type_field_offset(edge_type, 'dest')
+        self.flags_offset = type_field_offset(edge_type, 'flags')
+        self.flags_fmt = int_format(edge_type['flags'].type.sizeof)
+
+        # Old GCC versions have an integer probability, recent ones have a
+        # profile_probability structure where the value is a bit field.
+        # Decoding bit fields from raw memory is only supported on
+        # little-endian targets.
+        prob_type = edge_type['probability'].type.strip_typedefs()
+        self.prob_offset = type_field_offset(edge_type, 'probability')
+        if prob_type.code == gdb.TYPE_CODE_STRUCT:
+            m_val = prob_type['m_val']
+            self.prob_shift = m_val.bitpos
+            self.prob_mask = (1 << m_val.bitsize) - 1
+            self.prob_fmt = int_format(4)
+            if not self.prob_fmt.startswith('<'):
+                self.prob_fmt = None
+        else:
+            self.prob_shift = 0
+            self.prob_mask = -1
+            self.prob_fmt = int_format(prob_type.sizeof, signed=True)
+
+        self.bb_index_offset = field_offset('basic_block', 'index')
+        self.bb_index_fmt = int_format(
+            lookup_type('basic_block').target().strip_typedefs()['index']
+            .type.sizeof,
+            signed=True
+        )
+
+
+edge_layout = ObjfileCache('edge_layout', lambda _: EdgeLayout())
+
+
+class EdgeInfo(object):
+    """Plain data decoded for one edge."""
+
+    __slots__ = ('address', 'src', 'dest', 'src_index', 'dest_index',
+                 'flags', 'probability')
+
+    def __init__(self, address, src, dest, src_index, dest_index, flags,
+                 probability):
+        self.address = address
+        self.src = src
+        self.dest = dest
+        self.src_index = src_index
+        self.dest_index = dest_index
+        self.flags = flags
+        self.probability = probability
+
+    def __repr__(self):
+        return '<EdgeInfo BB {} -> BB {} flags:{:#x}>'.format(
+            self.src_index, self.dest_index, self.flags
+        )
+
+
+class EdgeList(object):
+    """
+    Array-backed list of edges, decoded from a `vec<edge, va_gc> *` value.
+
+    The vector is fetched with one memory read, then each edge structure and
+    the index of each distinct source/destination block are read once as
+    raw memory. `infos` holds the decoded EdgeInfo records, and Edge wrappers
+    are only created when indexing or iterating.
+    """
+
+    def __init__(self, vec, bb_indexes=None):
+        layout = edge_layout[None]
+        inferior = gdb.selected_inferior()
+        bb_indexes = {} if bb_indexes is None else bb_indexes
+
+        def bb_index(address):
+            try:
+                return bb_indexes[address]
+            except KeyError:
+                result = struct.unpack(
+                    layout.bb_index_fmt,
+                    inferior.read_memory(
+                        address + layout.bb_index_offset,
+                        struct.calcsize(layout.bb_index_fmt)
+                    )
+                )[0]
+                bb_indexes[address] = result
+                return result
+
+        self.infos = []
+        for address in read_vec_pointers(vec):
+            data = inferior.read_memory(address, layout.size).tobytes()
+            src = unpack_pointer(data, layout.src_offset)
+            dest = unpack_pointer(data, layout.dest_offset)
+            flags = struct.unpack_from(
+                layout.flags_fmt, data, layout.flags_offset
+            )[0]
+            if layout.prob_fmt is None:
+                probability = None
+            else:
+                probability = (struct.unpack_from(
+                    layout.prob_fmt, data, layout.prob_offset
+                )[0] >> layout.prob_shift) & layout.prob_mask
+            self.infos.append(EdgeInfo(
+                address, src, dest, bb_index(src), bb_index(dest), flags,
+                probability
+            ))
+
+    def __len__(self):
+        return len(self.infos)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        info = self.infos[i]
+        result = Edge(gdb.Value(info.address).cast(lookup_type('edge')))
+        result.info = info
+        return result
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return repr(list(self))
 
 
 class Loop(object):
 
     def __init__(self, value):
-        if isinstance(value, basestring):
+        if is_string(value):
             value = gdb.parse_and_eval(value)
 
         if not isinstance(value, gdb.Value):
@@ -156,32 +292,626 @@ class EdgePrinter(object):
         return str(Edge(self.value))
 
 
-def dump_dot(filename):
-    lines = ['digraph cfg {']
-    visited = set()
+def _flag_names(enum, prefix, flags):
+    return [
+        name[len(prefix):].lower()
+        for value, name in sorted(enum.value_to_name.items())
+        # Skip enumerators that are not flags, such as LAST_CFG_EDGE_FLAG
+        if value and name.startswith(prefix) and flags & value == value
+    ]
+
+
+def iter_basic_blocks(cfun='cfun'):
+    """
+    Yield all basic blocks in `cfun` (an expression or a gdb.Value for a
+    `struct function *`), reading `x_basic_block_info` in one go.
+    """
+    if is_string(cfun):
+        cfun = gdb.parse_and_eval(cfun)
+    basic_block = lookup_type('basic_block')
+    for address in read_vec_pointers(cfun['cfg']['x_basic_block_info']):
+        if address:
+            yield BasicBlock(gdb.Value(address).cast(basic_block))
+
 
-    def add_bb(bb):
-        if bb in visited:
+ENTRY_BLOCK = 0
+EXIT_BLOCK = 1
+
+
+class CFGDiff(object):
+    """Differences between two CFG snapshots (sets of indexes/edges)."""
+
+    def __init__(self, old, new):
+        old_blocks, new_blocks = set(old.blocks), set(new.blocks)
+        old_edges = set((s, d) for s, d, _ in old.edges())
+        new_edges = set((s, d) for s, d, _ in new.edges())
+        self.added_blocks = new_blocks - old_blocks
+        self.removed_blocks = old_blocks - new_blocks
+        self.added_edges = new_edges - old_edges
+        self.removed_edges = old_edges - new_edges
+
+    def __nonzero__(self):
+        return bool(self.added_blocks or self.removed_blocks or
+                    self.added_edges or self.removed_edges)
+
+    def __bool__(self):
+        return self.__nonzero__()
+
+    def __repr__(self):
+        def fmt_edges(edges):
+            return ', '.join('{}->{}'.format(s, d) for s, d in sorted(edges))
+        lines = []
+        for label, items in (
+            ('added blocks', ', '.join(map(str, sorted(self.added_blocks)))),
+            ('removed blocks',
+             ', '.join(map(str, sorted(self.removed_blocks)))),
+            ('added edges', fmt_edges(self.added_edges)),
+            ('removed edges', fmt_edges(self.removed_edges)),
+        ):
+            if items:
+                lines.append('{}: {}'.format(label, items))
+        return '\n'.join(lines) or '<no CFG difference>'
+
+
+class CFGSnapshot(object):
+    """
+    Copy of a whole CFG in plain integer arrays, so that graph algorithms can
+    run without reading the inferior again.
+
+    Blocks are designated by their index. Successors of block B are
+    `succ_targets[succ_offsets[B]:succ_offsets[B + 1]]` (and the same for
+    `succ_flags`), predecessors use `pred_offsets`/`pred_sources`. Blocks
+    that do not exist have empty ranges.
+    """
+
+    def __init__(self, blocks, succs):
+        """
+        `blocks` is the sorted list of existing block indexes and `succs`
+        maps each of them to a list of (dest, flags) couples.
+        """
+        self.blocks = array('l', blocks)
+        size = (blocks[-1] + 1) if blocks else 0
+
+        self.succ_offsets = array('l', [0])
+        self.succ_targets = array('l')
+        self.succ_flags = array('l')
+        pred_lists = [[] for _ in range(size)]
+        for b in range(size):
+            for dest, flags in succs.get(b, ()):
+                self.succ_targets.append(dest)
+                self.succ_flags.append(flags)
+                pred_lists[dest].append(b)
+            self.succ_offsets.append(len(self.succ_targets))
+
+        self.pred_offsets = array('l', [0])
+        self.pred_sources = array('l')
+        for preds in pred_lists:
+            self.pred_sources.extend(preds)
+            self.pred_offsets.append(len(self.pred_sources))
+
+        self._rpo = None
+        self._idoms = None
+
+    @classmethod
+    def capture(cls, cfun='cfun'):
+        """
+        Read all blocks and edges of `cfun` (an expression or a gdb.Value for
+        a `struct function *`) and return a snapshot for them.
+        """
+        if is_string(cfun):
+            cfun = gdb.parse_and_eval(cfun)
+        basic_block = lookup_type('basic_block')
+
+        # x_basic_block_info is indexed by block index
+        addresses = read_vec_pointers(cfun['cfg']['x_basic_block_info'])
+        bb_indexes = {a: i for i, a in enumerate(addresses) if a}
+
+        blocks = []
+        succs = {}
+        for index, address in enumerate(addresses):
+            if not address:
+                continue
+            bb = gdb.Value(address).cast(basic_block)
+            blocks.append(index)
+            succs[index] = [
+                (info.dest_index, info.flags)
+                for info in EdgeList(bb['succs'], bb_indexes).infos
+            ]
+        return cls(blocks, succs)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def successors(self, b):
+        if b + 1 >= len(self.succ_offsets):
+            return self.succ_targets[0:0]
+        return self.succ_targets[self.succ_offsets[b]:self.succ_offsets[b + 1]]
+
+    def predecessors(self, b):
+        if b + 1 >= len(self.pred_offsets):
+            return self.pred_sources[0:0]
+        return self.pred_sources[self.pred_offsets[b]:self.pred_offsets[b + 1]]
+
+    def edges(self):
+        """Yield all edges as (source, destination, flags) triples."""
+        offsets = self.succ_offsets
+        for b in range(len(offsets) - 1):
+            for i in range(offsets[b], offsets[b + 1]):
+                yield (b, self.succ_targets[i], self.succ_flags[i])
+
+    def reachable(self, start=ENTRY_BLOCK, reverse=False):
+        """
+        Return the set of blocks reachable from `start`, following edges
+        backwards if `reverse` is true.
+        """
+        next_blocks = self.predecessors if reverse else self.successors
+        result = set([start])
+        worklist = [start]
+        while worklist:
+            for n in next_blocks(worklist.pop()):
+                if n not in result:
+                    result.add(n)
+                    worklist.append(n)
+        return result
+
+    def _dfs(self, start):
+        """
+        Iterative depth-first search from `start`. Return the postorder list
+        and the list of retreating edges (edges to a block on the DFS stack).
+        """
+        postorder = []
+        retreating = []
+        visited = set([start])
+        on_stack = set([start])
+        stack = [(start, iter(self.successors(start)))]
+        while stack:
+            b, succs = stack[-1]
+            for n in succs:
+                if n in on_stack:
+                    retreating.append((b, n))
+                elif n not in visited:
+                    visited.add(n)
+                    on_stack.add(n)
+                    stack.append((n, iter(self.successors(n))))
+                    break
+            else:
+                stack.pop()
+                on_stack.discard(b)
+                postorder.append(b)
+        return postorder, retreating
+
+    def reverse_postorder(self):
+        """Return the list of blocks reachable from ENTRY_BLOCK in RPO."""
+        if self._rpo is None:
+            postorder, _ = self._dfs(ENTRY_BLOCK)
+            self._rpo = postorder[::-1]
+        return self._rpo
+
+    def back_edges(self):
+        """
+        Return the list of (source, destination) edges that are retreating
+        in a depth-first search from ENTRY_BLOCK.
+        """
+        return self._dfs(ENTRY_BLOCK)[1]
+
+    def immediate_dominators(self):
+        """
+        Return a dict mapping each block reachable from ENTRY_BLOCK to its
+        immediate dominator (ENTRY_BLOCK is its own dominator).
+
+        This uses the iterative algorithm from Cooper, Harvey and Kennedy.
+        """
+        if self._idoms is not None:
+            return self._idoms
+
+        rpo = self.reverse_postorder()
+        order = {b: i for i, b in enumerate(rpo)}
+        idoms = {ENTRY_BLOCK: ENTRY_BLOCK}
+
+        def intersect(a, b):
+            while a != b:
+                while order[a] > order[b]:
+                    a = idoms[a]
+                while order[b] > order[a]:
+                    b = idoms[b]
+            return a
+
+        changed = True
+        while changed:
+            changed = False
+            for b in rpo[1:]:
+                new_idom = None
+                for p in self.predecessors(b):
+                    if p not in idoms:
+                        continue
+                    new_idom = (p if new_idom is None else
+                                intersect(p, new_idom))
+                if idoms.get(b) != new_idom:
+                    idoms[b] = new_idom
+                    changed = True
+
+        self._idoms = idoms
+        return idoms
+
+    def dominates(self, a, b):
+        """Return whether block `a` dominates block `b`."""
+        idoms = self.immediate_dominators()
+        if b not in idoms:
+            return False
+        while b != a:
+            if b == ENTRY_BLOCK:
+                return False
+            b = idoms[b]
+        return True
+
+    def diff(self, other):
+        """
+        Return a CFGDiff describing how to go from `other` (for instance a
+        snapshot captured before a pass) to `self`.
+        """
+        return CFGDiff(other, self)
+
+    def __repr__(self):
+        return '<CFGSnapshot: {} blocks, {} edges>'.format(
+            len(self.blocks), len(self.succ_targets)
+        )
+
+
+class LoopInfo(object):
+    """Plain data captured for one loop in a LoopTree."""
+
+    def __init__(self, num, address, header, latch):
+        self.num = num
+        self.address = address
+        self.header = header
+        self.latch = latch
+        self.parent = None
+        self.children = []
+        self.depth = 0
+        self.blocks = set()
+
+    @property
+    def loop(self):
+        """Return a Loop wrapper for the original structure."""
+        loop_ptr = lookup_type('loop').pointer()
+        return Loop(gdb.Value(self.address).cast(loop_ptr))
+
+    def __repr__(self):
+        return '<LoopInfo {} header:{} latch:{} depth:{} {} blocks>'.format(
+            self.num, self.header, self.latch, self.depth, len(self.blocks)
+        )
+
+
+class LoopTree(object):
+    """
+    Loop hierarchy of a function, captured from its `x_current_loops` in
+    one pass.
+
+    `loops` maps loop numbers to LoopInfo records (loop 0 is the whole
+    function), `bb_loop` maps block indexes to the number of their
+    innermost loop. Both are computed once, so queries do not walk the
+    hierarchy.
+    """
+
+    def __init__(self, cfun='cfun'):
+        if is_string(cfun):
+            cfun = gdb.parse_and_eval(cfun)
+        self.cfun = cfun
+        self.loops = {}
+        self.bb_loop = {}
+        self._snapshot = None
+        self._exits = {}
+
+        loops = cfun['x_current_loops']
+        if not loops:
             return
-        visited.add(bb)
+        inferior = gdb.selected_inferior()
+
+        bb_addresses = read_vec_pointers(cfun['cfg']['x_basic_block_info'])
+        bb_indexes = {a: i for i, a in enumerate(bb_addresses) if a}
+
+        loop_type = lookup_type('loop')
+        loop_size = loop_type.sizeof
+        num_offset = field_offset('loop', 'num')
+        num_fmt = int_format(loop_type.strip_typedefs()['num'].type.sizeof,
+                             signed=True)
+        offsets = [field_offset('loop', name)
+                   for name in ('header', 'latch', 'inner', 'next')]
+
+        links = {}
+        loop_nums = {}
+        for address in read_vec_pointers(loops['larray']):
+            if not address:
+                continue
+            data = inferior.read_memory(address, loop_size).tobytes()
+            num = struct.unpack_from(num_fmt, data, num_offset)[0]
+            header, latch, inner, next_loop = [
+                unpack_pointer(data, o) for o in offsets
+            ]
+            self.loops[num] = LoopInfo(num, address, bb_indexes.get(header),
+                                       bb_indexes.get(latch))
+            links[num] = (inner, next_loop)
+            loop_nums[address] = num
+
+        # Rebuild the hierarchy from inner/next links
+        for num, (inner, _) in links.items():
+            child = inner
+            while child and child in loop_nums:
+                child_info = self.loops[loop_nums[child]]
+                child_info.parent = num
+                self.loops[num].children.append(child_info.num)
+                child = links[child_info.num][1]
+        roots = [l for l in self.loops.values() if l.parent is None]
+        worklist = list(roots)
+        while worklist:
+            info = worklist.pop()
+            for c in info.children:
+                self.loops[c].depth = info.depth + 1
+                worklist.append(self.loops[c])
+
+        # Assign blocks to their innermost loop, then to all enclosing ones
+        father_offset = field_offset('basic_block', 'loop_father')
+        ptr_size = pointer_size()
+        for address, index in bb_indexes.items():
+            father = unpack_pointer(inferior.read_memory(
+                address + father_offset, ptr_size
+            ))
+            num = loop_nums.get(father)
+            if num is None:
+                continue
+            self.bb_loop[index] = num
+            while num is not None:
+                self.loops[num].blocks.add(index)
+                num = self.loops[num].parent
+
+    @classmethod
+    def get(cls, cfun='cfun'):
+        """
+        Return the loop tree for `cfun`, captured at most once per stop.
+        """
+        if is_string(cfun):
+            cfun = gdb.parse_and_eval(cfun)
+        return loop_trees[ptr_to_int(cfun)]
+
+    def __getitem__(self, num):
+        return self.loops[num]
+
+    def __len__(self):
+        return len(self.loops)
+
+    def loop_of(self, bb_index):
+        """
+        Return the LoopInfo for the innermost loop that contains the
+        `bb_index` block, or None if it is in no loop.
+        """
+        num = self.bb_loop.get(bb_index)
+        return None if num is None else self.loops[num]
+
+    def contains(self, num, bb_index):
+        """Return whether the `num` loop contains the `bb_index` block."""
+        return bb_index in self.loops[num].blocks
+
+    def superloops(self, num):
+        """Return the list of loops enclosing `num`, outermost first."""
+        result = []
+        num = self.loops[num].parent
+        while num is not None:
+            result.append(num)
+            num = self.loops[num].parent
+        return result[::-1]
+
+    def exits(self, num):
+        """
+        Return the list of (source, destination) edges leaving the `num`
+        loop.
+        """
+        try:
+            return self._exits[num]
+        except KeyError:
+            pass
+        if self._snapshot is None:
+            self._snapshot = CFGSnapshot.capture(self.cfun)
+        blocks = self.loops[num].blocks
+        result = [
+            (b, dest)
+            for b in sorted(blocks)
+            for dest in self._snapshot.successors(b)
+            if dest not in blocks
+        ]
+        self._exits[num] = result
+        return result
+
+    def dump(self):
+        """Return a textual representation of the loop hierarchy."""
+        lines = []
+        worklist = sorted(
+            (l.num for l in self.loops.values() if l.parent is None),
+            reverse=True
+        )
+        while worklist:
+            info = self.loops[worklist.pop()]
+            lines.append('{}loop {}: header BB {}, latch BB {}, {} blocks'
+                         .format('  ' * info.depth, info.num, info.header,
+                                 info.latch, len(info.blocks)))
+            worklist.extend(sorted(info.children, reverse=True))
+        return '\n'.join(lines)
 
-        lines.append('bb_{index} [shape=box, label="BB {index}"];'.format(
-            index=bb.index
+    def __repr__(self):
+        return '<LoopTree: {} loops>'.format(len(self.loops))
+
+
+loop_trees = StopCache('loop_trees', lambda address: LoopTree(
+    gdb.Value(address).cast(lookup_type('function').pointer())
+))
+
+
+def insn_count(bb):
+    """
+    Return the number of GIMPLE statements or RTL instructions in `bb`.
+    """
+    flags = int(bb.value['flags'])
+    bb_flags = lookup_enum('enum cfg_bb_flags')
+    if flags & bb_flags.name_to_value['BB_RTL']:
+        il = bb.value['il']['x']
+        head = ptr_to_int(il['head_'])
+        end = ptr_to_int(il['rtl']['end_']) if il['rtl'] else 0
+        if not head:
+            return 0
+        # NEXT_INSN is the second operand of instructions
+        next_offset = (field_offset('rtx', 'u')
+                       + lookup_type('rtunion').sizeof)
+        count = 0
+        for insn in iter_pointer_chain(head, next_offset):
+            count += 1
+            if insn == end:
+                break
+        return count
+    else:
+        seq = ptr_to_int(bb.value['il']['gimple']['seq'])
+        return sum(1 for _ in iter_pointer_chain(
+            seq, field_offset('gimple', 'next')
         ))
-        for edge in bb.succs:
-            succ = edge.destination
-            lines.append('bb_{} -> bb_{};'.format(
-                bb.index, succ.index
-            ))
-            add_bb(succ)
-
-    entry_bb = BasicBlock(gdb.parse_and_eval('cfun.cfg.x_entry_block_ptr'))
-    add_bb(entry_bb)
-    lines.append('}')
-
-    dot = subprocess.Popen(
-        ['dot', '-Tpng', '-o', filename],
-        stdin=subprocess.PIPE
-    )
-    dot.communicate('\n'.join(lines))
-    assert dot.returncode == 0
+
+
+def write_dot(out, cfun='cfun', edge_flags=False, loops=False,
+              insn_counts=False):
+    """
+    Write the CFG of `cfun` in the Graphviz format to the `out` text stream.
+
+    If `edge_flags` is true, label edges with their flags. If `loops` is
+    true, group basic blocks in clusters for their innermost loop. If
+    `insn_counts` is true, add the number of statements/instructions to each
+    basic block label.
+    """
+    edge_enum = lookup_enum('enum cfg_edge_flags') if edge_flags else None
+    clusters = {}
+
+    out.write('digraph cfg {\n')
+    for bb in iter_basic_blocks(cfun):
+        index = bb.index
+        label = 'BB {}'.format(index)
+        if insn_counts:
+            label += '\\n{} insns'.format(insn_count(bb))
+        node = 'bb_{} [shape=box, label="{}"];\n'.format(index, label)
+
+        loop = bb.value['loop_father'] if loops else None
+        if loop and int(loop['num']):
+            clusters.setdefault(int(loop['num']), []).append(node)
+        else:
+            out.write(node)
+
+        for edge in bb.succs.infos:
+            dest = edge.dest_index
+            if edge_enum is not None:
+                out.write('bb_{} -> bb_{} [label="{}"];\n'.format(
+                    index, dest, ','.join(_flag_names(
+                        edge_enum, 'EDGE_', edge.flags
+                    ))
+                ))
+            else:
+                out.write('bb_{} -> bb_{};\n'.format(index, dest))
+
+    for num in sorted(clusters):
+        out.write('subgraph cluster_loop_{num} {{\n'
+                  'label="loop {num}";\n'.format(num=num))
+        for node in clusters[num]:
+            out.write(node)
+        out.write('}\n')
+    out.write('}\n')
+
+
+def _wait_for_dot(proc, filename, dot_filename):
+    returncode = proc.wait()
+    os.remove(dot_filename)
+    if returncode == 0:
+        message = 'CFG rendered to {}\n'.format(filename)
+    else:
+        message = 'dot failed (exit status {}) for {}\n'.format(
+            returncode, filename
+        )
+    gdb.post_event(lambda: gdb.write(message))
+
+
+def dump_dot(filename, cfun='cfun', edge_flags=False, loops=False,
+             insn_counts=False, wait=False):
+    """
+    Dump the CFG of `cfun` to `filename`.
+
+    If `filename` ends with ".dot", just write the Graphviz source to it.
+    Otherwise, write the source to a temporary file and render it in the
+    format matching the extension of `filename` (PNG by default) with a
+    background `dot` process, unless `wait` is true. The temporary file is
+    removed once rendering is over. See `write_dot` for the other options.
+    """
+    base, ext = os.path.splitext(filename)
+    if ext == '.dot':
+        with open(filename, 'w') as f:
+            write_dot(f, cfun, edge_flags, loops, insn_counts)
+        return
+
+    fd, dot_filename = tempfile.mkstemp(suffix='.dot')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            write_dot(f, cfun, edge_flags, loops, insn_counts)
+    except:
+        os.remove(dot_filename)
+        raise
+
+    try:
+        proc = subprocess.Popen(
+            ['dot', '-T{}'.format(ext[1:] or 'png'), '-o', filename,
+             dot_filename]
+        )
+    except OSError:
+        os.remove(dot_filename)
+        raise
+    if wait:
+        returncode = proc.wait()
+        os.remove(dot_filename)
+        if returncode != 0:
+            raise gdb.GdbError('dot failed for {}'.format(filename))
+    else:
+        thread = threading.Thread(target=_wait_for_dot,
+                                  args=(proc, filename, dot_filename))
+        thread.daemon = True
+        thread.start()
+
+
+class DumpDotCommand(gdb.Command):
+    """
+    Render the CFG for the current function with Graphviz.
+
+    Usage: gcc-cfg-dot [--edge-flags] [--loops] [--insns] [--wait] FILE
+
+    Rendering happens in the background unless --wait is passed. If FILE
+    ends with ".dot", only write the Graphviz source.
+    """
+
+    options = {
+        '--edge-flags': 'edge_flags',
+        '--loops': 'loops',
+        '--insns': 'insn_counts',
+        '--wait': 'wait',
+    }
+
+    def __init__(self, name='gcc-cfg-dot'):
+        super(DumpDotCommand, self).__init__(
+            name, gdb.COMMAND_DATA, gdb.COMPLETE_FILENAME
+        )
+
+    def invoke(self, arg, from_tty):
+        kwargs = {}
+        filenames = []
+        for a in gdb.string_to_argv(arg):
+            if a in self.options:
+                kwargs[self.options[a]] = True
+            elif a.startswith('--'):
+                raise gdb.GdbError('Invalid option: {}'.format(a))
+            else:
+                filenames.append(a)
+        if len(filenames) != 1:
+            raise gdb.GdbError(
+                'Usage: gcc-cfg-dot [--edge-flags] [--loops] [--insns]'
+                ' [--wait] FILE'
+            )
+        dump_dot(filenames[0], **kwargs)
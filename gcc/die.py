@@ -1,11 +1,97 @@
+from itertools import islice
+import struct
+
 import gdb
 import gdb.types
 
-from gcc.utils import Enum, is_string, ptr_to_int
+from gcc.cache import ObjfileCache, StopCache, lookup_type
+from gcc.dieformat import DIERef, ENUM_TABLES, Opaque, SnapshotWriter
+from gcc.tree import Tree
+from gcc.utils import (
+    Enum, field_offset, int_format, is_string, iter_pointer_chain,
+    ptr_to_int, read_memory, read_pointer, type_field_offset
+)
 
 
+dwarf_tag = Enum(gdb.lookup_type('enum dwarf_tag'))
 dwarf_attribute = Enum(gdb.lookup_type('enum dwarf_attribute'))
 dw_val_class = Enum(gdb.lookup_type('enum dw_val_class'))
+dwarf_location_atom = Enum(gdb.lookup_type('enum dwarf_location_atom'))
+
+
+class AttributeVectorLayout(object):
+    """
+    Offsets and sizes needed to decode `die_attr` vectors from raw memory.
+    """
+
+    def __init__(self):
+        die_type = lookup_type('dw_die_ref').target().strip_typedefs()
+        vec_type = die_type['die_attr'].type.strip_typedefs().target()
+        attr_type = lookup_type('dw_attr_node')
+
+        self.die_attr_offset = field_offset('dw_die_ref', 'die_attr')
+        self.num_offset = type_field_offset(vec_type, 'm_vecpfx', 'm_num')
+        self.num_size = (vec_type.strip_typedefs()['m_vecpfx'].type
+                         .strip_typedefs()['m_num'].type.sizeof)
+        self.data_offset = type_field_offset(vec_type, 'm_vecdata')
+        self.attr_ptr_type = attr_type.pointer()
+        self.attr_size = attr_type.sizeof
+        self.attr_offset = type_field_offset(attr_type, 'dw_attr')
+        self.attr_fmt = int_format(attr_type.strip_typedefs()['dw_attr']
+                                   .type.sizeof)
+
+
+attr_vec_layout = ObjfileCache(
+    'attr_vec_layout', lambda _: AttributeVectorLayout()
+)
+
+
+class AttributeIndex(object):
+    """
+    Decoded `die_attr` vector for one DIE: `addresses` contains the address
+    of each dw_attr_node, `by_attr` maps dwarf_attribute integers to indexes
+    in `addresses` (first occurrence wins).
+    """
+
+    def __init__(self, die_address):
+        layout = attr_vec_layout[None]
+        self.addresses = []
+        self.by_attr = {}
+
+        vec = read_pointer(die_address + layout.die_attr_offset)
+        if not vec:
+            return
+        num = struct.unpack(
+            int_format(layout.num_size),
+            read_memory(vec + layout.num_offset, layout.num_size)
+        )[0]
+        if not num:
+            return
+
+        # Fetch the whole array of attributes at once and decode only the
+        # attribute kinds, the values are decoded on demand.
+        data_address = vec + layout.data_offset
+        data = read_memory(data_address, num * layout.attr_size)
+        for i in range(num):
+            offset = i * layout.attr_size
+            attr = struct.unpack_from(
+                layout.attr_fmt, data, offset + layout.attr_offset
+            )[0]
+            self.addresses.append(data_address + offset)
+            self.by_attr.setdefault(attr, i)
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def attribute(self, i):
+        layout = attr_vec_layout[None]
+        return Attribute(
+            gdb.Value(self.addresses[i])
+            .cast(layout.attr_ptr_type).dereference()
+        )
+
+
+attribute_indexes = StopCache('die_attributes', AttributeIndex)
 
 
 class DIE(object):
@@ -18,13 +104,16 @@ class DIE(object):
         if is_string(value):
             value = gdb.parse_and_eval(value)
         elif isinstance(value, int):
-            value = gdb.Value(value).caste(gdb.lookup_type('dw_die_ref'))
+            value = gdb.Value(value).cast(lookup_type('dw_die_ref'))
 
         self.value = value
 
     def __nonzero__(self):
         return bool(self.value)
 
+    def __bool__(self):
+        return self.__nonzero__()
+
     def __eq__(self, other):
         return other and self.value == other.value
 
@@ -41,15 +130,43 @@ class DIE(object):
         there is no such enum dwarf_attribute value and raise a KeyError if
         there is no such attribute.
         """
+        index = self.attribute_index
         if isinstance(key, int):
-            return self.attributes[key]
+            if not -len(index) <= key < len(index):
+                raise IndexError(key)
+            return index.attribute(key)
+
+        attr = self._attribute_kind(key)
+        try:
+            return index.attribute(index.by_attr[attr])
+        except KeyError:
+            raise KeyError('No such attribute: {}'.format(key))
 
-        assert isinstance(key, basestring)
-        attr = dwarf_attribute.name_to_value[key]
-        for c in self.attributes:
-            if c.attr == attr:
-                return c
-        raise KeyError('No such attribute: {}'.format(attr))
+    def get(self, key, default=None):
+        """
+        Return the attribute for the `key` dwarf_attribute name (e.g.
+        'DW_AT_type') or `default` if this DIE has no such attribute.
+        """
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def has(self, key):
+        """
+        Return whether this DIE has an attribute for the `key`
+        dwarf_attribute name. Raise a ValueError if there is no such enum
+        dwarf_attribute value.
+        """
+        return self._attribute_kind(key) in self.attribute_index.by_attr
+
+    @staticmethod
+    def _attribute_kind(key):
+        assert is_string(key)
+        try:
+            return dwarf_attribute.name_to_value[key]
+        except KeyError:
+            raise ValueError('No such attribute kind: {}'.format(key))
 
     @property
     def struct(self):
@@ -77,17 +194,17 @@ class DIE(object):
 
     @property
     def siblings(self):
-        result = [self]
-        while True:
-            sib = result[-1].sibling
-
-            # Sibling lists are supposed to be circular lists, but it can
-            # happen from time to time, for instance in the middle of the
-            # type pruning pass, that we temporarily have a NULL-terminated
-            # list: handle that for debug convenience.
-            if not sib or sib == self:
-                return result
-            result.append(sib)
+        # Sibling lists are supposed to be circular lists, but it can happen
+        # from time to time, for instance in the middle of the type pruning
+        # pass, that we temporarily have a NULL-terminated list: the chain
+        # walker handles both.
+        address = self.address
+        return [
+            DIE(sib)
+            for sib in iter_pointer_chain(
+                address, field_offset('dw_die_ref', 'die_sib'), address
+            )
+        ]
 
     @property
     def children(self):
@@ -99,39 +216,79 @@ class DIE(object):
         """
         Return the whole parent chain starting from `self` (included).
         """
-        p = self
-        result = []
-        while p:
-            result.append(p)
-            p = p.parent
-        return result
+        return [
+            DIE(p)
+            for p in iter_pointer_chain(
+                self.address, field_offset('dw_die_ref', 'die_parent')
+            )
+        ]
+
+    @property
+    def attribute_index(self):
+        """
+        Return the AttributeIndex for this DIE (decoded once per stop).
+        """
+        return attribute_indexes[self.address]
 
     @property
     def attributes(self):
-        vec = self.struct['die_attr']
-        if not ptr_to_int(vec):
-            return []
-        vec = vec.dereference()
-        num = int(vec['m_vecpfx']['m_num'])
-        return [Attribute(vec['m_vecdata'][i])
-                for i in range(num)]
+        index = self.attribute_index
+        return [index.attribute(i) for i in range(len(index))]
 
     @property
     def iter_tree(self):
         """
         Yield all DIEs in self's subtree.
         """
-        yield self
-        for c in self.children:
-            for ci in c.iter_tree:
-                yield ci
+        return self.iter_subtree()
 
-    def find(self, predicate):
+    def iter_subtree(self, prune=None):
+        """
+        Yield all DIEs in self's subtree, parents first, in the same order as
+        `children`.
+
+        If provided, `prune` is called on each yielded DIE: when it returns
+        true, the DIE's descendants are skipped.
+        """
+        child_offset = field_offset('dw_die_ref', 'die_child')
+        sib_offset = field_offset('dw_die_ref', 'die_sib')
+
+        # Use an explicit stack of sibling chain iterators so that the depth
+        # of the DIE tree does not translate into Python recursion. DIEs are
+        # only created for yielded nodes.
+        if not self.address:
+            return
+        stack = []
+        die = self
+        while True:
+            yield die
+            if prune is None or not prune(die):
+                child = read_pointer(die.address + child_offset)
+                if child:
+                    stack.append(iter_pointer_chain(child, sib_offset, child))
+
+            die = None
+            while stack:
+                for address in stack[-1]:
+                    die = DIE(address)
+                    break
+                else:
+                    stack.pop()
+                    continue
+                break
+            if die is None:
+                return
+
+    def find(self, predicate, prune=None, limit=None):
         """
         Return the list of all DIEs in the `self` subtree for which the
         `predicate` function returns true.
+
+        `prune` is passed to `iter_subtree` to skip whole subtrees. If `limit`
+        is provided, stop the traversal as soon as `limit` DIEs are found.
         """
-        return [d for d in self.iter_tree if predicate(d)]
+        matches = (d for d in self.iter_subtree(prune) if predicate(d))
+        return list(islice(matches, limit))
 
     @property
     def name(self):
@@ -139,10 +296,8 @@ class DIE(object):
         If this DIE has a DW_AT_name attribute, return its string value.
         Otherwise, return None.
         """
-        try:
-            return self['DW_AT_name'].val
-        except KeyError:
-            return None
+        attr = self.get('DW_AT_name')
+        return attr.val if attr is not None else None
 
     def __repr__(self):
         if not self.value:
@@ -153,13 +308,266 @@ class DIE(object):
         return '<{} {}{}>'.format(self.tag, name_repr, hex(self.address))
 
 
+#
+# Decoders for dw_val_node values. Each one takes the `v` union of a
+# dw_val_node and returns the corresponding Python value.
+#
+
+def _string_or_none(value):
+    return value.string() if value else None
+
+
+def _decode_none(v):
+    return None
+
+
+def _decode_addr(v):
+    # There is no wrapper for RTL: return the raw rtx value
+    return v['val_addr']
+
+
+def _decode_offset(v):
+    return int(v['val_offset'])
+
+
+def _decode_int(v):
+    return int(v['val_int'])
+
+
+def _decode_unsigned(v):
+    return int(v['val_unsigned'])
+
+
+def _decode_const_double(v):
+    double = v['val_double']
+    low = double['low']
+    return int(double['high']) << (8 * low.type.sizeof) | int(low)
+
+
+def _decode_wide_int(v):
+    wide = v['val_wide'].dereference()
+    length = int(wide['len'])
+    try:
+        elts = wide['val']
+    except gdb.error:
+        # Recent GCC versions keep inline elements in a union
+        elts = wide['u']['val']
+    bits = 8 * elts[0].type.sizeof
+    mask = (1 << bits) - 1
+    result = 0
+    for i in range(length):
+        result |= (int(elts[i]) & mask) << (i * bits)
+    # Elements are sign-extended from the most significant one
+    if length and int(elts[length - 1]) < 0:
+        result -= 1 << (length * bits)
+    return result
+
+
+def _decode_vec(v):
+    vec = v['val_vec']
+    length = int(vec['length'])
+    elt_size = int(vec['elt_size'])
+    if not length:
+        return []
+    data = read_memory(ptr_to_int(vec['array']), length * elt_size)
+    if elt_size in (1, 2, 4, 8):
+        return list(struct.unpack(int_format(elt_size, count=length), data))
+    return [data[i * elt_size:(i + 1) * elt_size] for i in range(length)]
+
+
+def _decode_flag(v):
+    return bool(v['val_flag'])
+
+
+def _decode_die_ref(v):
+    return DIE(v['val_die_ref']['die'])
+
+
+def _decode_fde_ref(v):
+    return int(v['val_fde_index'])
+
+
+def _decode_label(v):
+    return _string_or_none(v['val_lbl_id'])
+
+
+def _decode_str(v):
+    return v['val_str'].dereference()['str'].string()
+
+
+def _decode_file(v):
+    file_data = v['val_file']
+    if not file_data:
+        return None
+    return _string_or_none(file_data.dereference()['filename'])
+
+
+def _decode_data8(v):
+    data = v['val_data8']
+    return bytes(bytearray(int(data[i]) for i in range(8)))
+
+
+def _decode_decl_ref(v):
+    return Tree(v['val_decl_ref'])
+
+
+def _decode_vms_delta(v):
+    delta = v['val_vms_delta']
+    return (_string_or_none(delta['lbl1']), _string_or_none(delta['lbl2']))
+
+
+def _discr_value(value):
+    return int(value['v']['uval'] if value['pos'] else value['v']['sval'])
+
+
+def _decode_discr_value(v):
+    return _discr_value(v['val_discr_value'])
+
+
+def _decode_discr_list(v):
+    result = []
+    node = v['val_discr_list']
+    while node:
+        node = node.dereference()
+        low = _discr_value(node['dw_discr_lower_bound'])
+        if node['dw_discr_range']:
+            result.append((low, _discr_value(node['dw_discr_upper_bound'])))
+        else:
+            result.append(low)
+        node = node['dw_discr_next']
+    return result
+
+
+def _decode_loc(v):
+    return decode_location_expression(v['val_loc'])
+
+
+def _decode_loc_list(v):
+    result = []
+    node = v['val_loc_list']
+    while node:
+        node = node.dereference()
+        result.append((
+            _string_or_none(node['begin']),
+            _string_or_none(node['end']),
+            decode_location_expression(node['expr'])
+        ))
+        node = node['dw_loc_next']
+    return result
+
+
+def _decode_view_list(v):
+    return DIE(v['val_view_list'])
+
+
+def _decode_symview(v):
+    return _string_or_none(v['val_symbolic_view'])
+
+
+# Not all classes exist in all GCC versions: only keep the ones that are
+# present in the debugged compiler.
+val_decoders = {
+    dw_val_class.name_to_value[name]: decoder
+    for name, decoder in (
+        ('dw_val_class_none', _decode_none),
+        ('dw_val_class_addr', _decode_addr),
+        ('dw_val_class_offset', _decode_offset),
+        ('dw_val_class_loc', _decode_loc),
+        ('dw_val_class_loc_list', _decode_loc_list),
+        ('dw_val_class_range_list', _decode_offset),
+        ('dw_val_class_const', _decode_int),
+        ('dw_val_class_unsigned_const', _decode_unsigned),
+        ('dw_val_class_const_double', _decode_const_double),
+        ('dw_val_class_wide_int', _decode_wide_int),
+        ('dw_val_class_vec', _decode_vec),
+        ('dw_val_class_flag', _decode_flag),
+        ('dw_val_class_die_ref', _decode_die_ref),
+        ('dw_val_class_fde_ref', _decode_fde_ref),
+        ('dw_val_class_lbl_id', _decode_label),
+        ('dw_val_class_lineptr', _decode_label),
+        ('dw_val_class_str', _decode_str),
+        ('dw_val_class_macptr', _decode_label),
+        ('dw_val_class_loclistsptr', _decode_label),
+        ('dw_val_class_file', _decode_file),
+        ('dw_val_class_data8', _decode_data8),
+        ('dw_val_class_decl_ref', _decode_decl_ref),
+        ('dw_val_class_vms_delta', _decode_vms_delta),
+        ('dw_val_class_high_pc', _decode_label),
+        ('dw_val_class_discr_value', _decode_discr_value),
+        ('dw_val_class_discr_list', _decode_discr_list),
+        ('dw_val_class_const_implicit', _decode_int),
+        ('dw_val_class_unsigned_const_implicit', _decode_unsigned),
+        ('dw_val_class_file_implicit', _decode_file),
+        ('dw_val_class_view_list', _decode_view_list),
+        ('dw_val_class_symview', _decode_symview),
+    )
+    if name in dw_val_class.name_to_value
+}
+
+
+def decode_val(val_node):
+    """
+    Decode a `dw_val_node` value into a Python value. Raise a
+    NotImplementedError if its class is not supported.
+    """
+    val_class = int(val_node['val_class'])
+    try:
+        decoder = val_decoders[val_class]
+    except KeyError:
+        raise NotImplementedError(
+            dw_val_class.value_to_name.get(val_class, str(val_class))
+        )
+    return decoder(val_node['v'])
+
+
+_val_class_none = dw_val_class.name_to_value['dw_val_class_none']
+_branch_ops = frozenset(
+    dwarf_location_atom.name_to_value[name]
+    for name in ('DW_OP_skip', 'DW_OP_bra')
+    if name in dwarf_location_atom.name_to_value
+)
+
+
+def decode_location_expression(loc):
+    """
+    Decode a `dw_loc_descr_ref` chain into a list of tuples: the operation
+    name followed by its decoded operands.
+
+    Operands of DW_OP_skip and DW_OP_bra are decoded as the index of the
+    target operation in the list (None if it is outside of it).
+    """
+    ops = []
+    node = loc
+    while node:
+        ops.append(node.dereference())
+        node = node['dw_loc_next']
+    addresses = {
+        ptr_to_int(op.address): i for i, op in enumerate(ops)
+    }
+
+    result = []
+    for op in ops:
+        opcode = int(op['dw_loc_opc'])
+        item = [dwarf_location_atom.value_to_name.get(opcode, opcode)]
+        for operand in (op['dw_loc_oprnd1'], op['dw_loc_oprnd2']):
+            if int(operand['val_class']) == _val_class_none:
+                continue
+            if opcode in _branch_ops:
+                target = operand['v']['val_loc']
+                item.append(addresses.get(ptr_to_int(target)))
+            else:
+                item.append(decode_val(operand))
+        result.append(tuple(item))
+    return result
+
+
 class Attribute(object):
     """
     Python wrapper around `dw_attr_struct` values to ease data access.
     """
 
     def __init__(self, value):
-        if isinstance(value, basestring):
+        if is_string(value):
             value = gdb.parse_and_eval(value)
         self.value = value
 
@@ -173,14 +581,7 @@ class Attribute(object):
 
     @property
     def val(self):
-        val_class = self.val_class
-        v = self.value['dw_attr_val']['v']
-        if val_class == dw_val_class.dw_val_class_str:
-            return v['val_str'].dereference()['str'].string()
-        elif val_class == dw_val_class.dw_val_class_die_ref:
-            return DIE(v['val_die_ref']['die'])
-        else:
-            raise NotImplementedError(str(val_class))
+        return decode_val(self.value['dw_attr_val'])
 
     def __repr__(self):
         try:
@@ -190,6 +591,78 @@ class Attribute(object):
         return '<{} {}>'.format(self.attr, val)
 
 
+def _snapshot_value(value):
+    """Convert a decoded attribute value for gcc.dieformat."""
+    if isinstance(value, DIE):
+        return DIERef(value.address)
+    elif isinstance(value, (list, tuple)):
+        return [_snapshot_value(v) for v in value]
+    elif isinstance(value, (int, bool, bytes, bytearray)) or is_string(value):
+        return value
+    elif value is None:
+        return None
+    else:
+        return Opaque(str(value))
+
+
+def write_snapshot(die, out):
+    """
+    Serialize the subtree of `die` to the `out` binary stream using the
+    gcc.dieformat format, in a single streaming pass. Return the number of
+    DIEs written.
+    """
+    enums = {'dwarf_tag': dwarf_tag,
+             'dwarf_attribute': dwarf_attribute,
+             'dw_val_class': dw_val_class}
+    writer = SnapshotWriter(out, {
+        name: enums[name].value_to_name for name in ENUM_TABLES
+    })
+    parent_offset = field_offset('dw_die_ref', 'die_parent')
+
+    for d in die.iter_subtree():
+        attributes = []
+        for attr in d.attributes:
+            try:
+                value = _snapshot_value(attr.val)
+            except NotImplementedError:
+                value = None
+            except gdb.error as exc:
+                value = Opaque('<{}>'.format(exc))
+            attributes.append((int(attr.attr), int(attr.val_class), value))
+
+        writer.add_die(d.address, read_pointer(d.address + parent_offset),
+                       int(d.tag), attributes)
+    writer.close()
+    return writer.count
+
+
+class DIESnapshotCommand(gdb.Command):
+    """
+    Save a DIE subtree to a snapshot file.
+
+    Usage: gcc-die-snapshot DIE-EXPR FILE
+
+    Snapshot files can be loaded outside of GDB with gcc.dieformat.load.
+    """
+
+    def __init__(self, name='gcc-die-snapshot'):
+        super(DIESnapshotCommand, self).__init__(
+            name, gdb.COMMAND_DATA, gdb.COMPLETE_EXPRESSION
+        )
+
+    def invoke(self, arg, from_tty):
+        argv = gdb.string_to_argv(arg)
+        if len(argv) != 2:
+            raise gdb.GdbError('Usage: gcc-die-snapshot DIE-EXPR FILE')
+        die = DIE(argv[0])
+        if not die:
+            raise gdb.GdbError('Cannot snapshot a NULL DIE')
+
+        with open(argv[1], 'wb') as f:
+            count = write_snapshot(die, f)
+        gdb.write('Wrote {} DIEs to {}\n'.format(count, argv[1]))
+
+
 class DIEPrinter(object):
     name = 'dw_die_ref'
     pointed_name = 'die_struct'
@@ -0,0 +1,528 @@
+"""
+Compact on-disk format for DIE tree snapshots.
+
+This module does not depend on GDB: snapshots are written from GDB (see the
+gcc-die-snapshot command) and can be loaded from any Python interpreter:
+
+    $ python -m gcc.dieformat snapshot.die > snapshot.txt
+
+A snapshot file is a header (magic string and enumeration name tables)
+followed by one record per DIE, in depth-first order (parents first). All
+integers are encoded as variable-length unsigned integers (LEB128).
+"""
+
+from array import array
+import io
+import sys
+
+
+MAGIC = b'GCCDIE\x01'
+
+# Record kinds
+_RECORD_DIE = 1
+_RECORD_END = 0
+
+# Value kinds
+_VAL_NONE = 0
+_VAL_INT = 1
+_VAL_STR = 2
+_VAL_DIE_REF = 3
+_VAL_BOOL = 4
+_VAL_BYTES = 5
+_VAL_LIST = 6
+_VAL_OPAQUE = 7
+
+# Name tables stored in the header, in this order
+ENUM_TABLES = ('dwarf_tag', 'dwarf_attribute', 'dw_val_class')
+
+
+class DIERef(object):
+    """Reference to a DIE, identified by its address in the compiler."""
+
+    __slots__ = ('address', )
+
+    def __init__(self, address):
+        self.address = address
+
+    def __eq__(self, other):
+        return isinstance(other, DIERef) and self.address == other.address
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.address)
+
+    def __repr__(self):
+        return '<DIERef {:#x}>'.format(self.address)
+
+
+class Opaque(object):
+    """Attribute value that could not be decoded, kept as its text form."""
+
+    __slots__ = ('text', )
+
+    def __init__(self, text):
+        self.text = text
+
+    def __eq__(self, other):
+        return isinstance(other, Opaque) and self.text == other.text
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.text)
+
+    def __repr__(self):
+        return '<opaque {}>'.format(self.text)
+
+
+#
+# Encoding
+#
+
+def _write_uint(out, value):
+    buf = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            buf.append(byte | 0x80)
+        else:
+            buf.append(byte)
+            break
+    out.write(bytes(buf))
+
+
+def _write_int(out, value):
+    # Zigzag encoding so that small negative integers stay small
+    _write_uint(out, (value << 1) if value >= 0 else ((-value << 1) - 1))
+
+
+def _write_bytes(out, value):
+    _write_uint(out, len(value))
+    out.write(value)
+
+
+def _write_str(out, value):
+    _write_bytes(out, value.encode('utf-8'))
+
+
+def _write_value(out, value):
+    if value is None:
+        _write_uint(out, _VAL_NONE)
+    elif isinstance(value, bool):
+        _write_uint(out, _VAL_BOOL)
+        _write_uint(out, int(value))
+    elif isinstance(value, int):
+        _write_uint(out, _VAL_INT)
+        _write_int(out, value)
+    elif isinstance(value, DIERef):
+        _write_uint(out, _VAL_DIE_REF)
+        _write_uint(out, value.address)
+    elif isinstance(value, (bytes, bytearray)):
+        _write_uint(out, _VAL_BYTES)
+        _write_bytes(out, bytes(value))
+    elif isinstance(value, (list, tuple)):
+        _write_uint(out, _VAL_LIST)
+        _write_uint(out, len(value))
+        for item in value:
+            _write_value(out, item)
+    elif isinstance(value, Opaque):
+        _write_uint(out, _VAL_OPAQUE)
+        _write_str(out, value.text)
+    elif isinstance(value, str):
+        _write_uint(out, _VAL_STR)
+        _write_str(out, value)
+    else:
+        _write_uint(out, _VAL_OPAQUE)
+        _write_str(out, str(value))
+
+
+class SnapshotWriter(object):
+    """
+    Streaming writer for snapshot files.
+
+    `enum_tables` must map each name in ENUM_TABLES to a dict that maps
+    integers to enumerator names. DIEs must be added parents first.
+    """
+
+    def __init__(self, out, enum_tables):
+        self.out = out
+        self.count = 0
+        self.indexes = {}
+
+        out.write(MAGIC)
+        for name in ENUM_TABLES:
+            table = enum_tables[name]
+            _write_uint(out, len(table))
+            for value in sorted(table):
+                _write_uint(out, value)
+                _write_str(out, table[value])
+
+    def add_die(self, address, parent_address, tag, attributes):
+        """
+        Add a DIE record. `attributes` is a sequence of (attr, val_class,
+        value) triples, where `attr` and `val_class` are integers.
+        """
+        out = self.out
+        _write_uint(out, _RECORD_DIE)
+        _write_uint(out, address)
+        parent = self.indexes.get(parent_address)
+        _write_uint(out, 0 if parent is None else parent + 1)
+        _write_uint(out, tag)
+        _write_uint(out, len(attributes))
+        for attr, val_class, value in attributes:
+            _write_uint(out, attr)
+            _write_uint(out, val_class)
+            _write_value(out, value)
+
+        self.indexes[address] = self.count
+        self.count += 1
+
+    def close(self):
+        _write_uint(self.out, _RECORD_END)
+
+
+#
+# Decoding
+#
+
+def _decode_uint(data, pos):
+    """
+    Decode the LEB128 integer at `pos` in the `data` bytearray and return it
+    with the position of the next byte.
+    """
+    result = 0
+    shift = 0
+    try:
+        while True:
+            byte = data[pos]
+            pos += 1
+            result |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return result, pos
+            shift += 7
+    except IndexError:
+        raise ValueError('Truncated snapshot file')
+
+
+class _Reader(object):
+    """Decoder for snapshot data, loaded in memory at once."""
+
+    def __init__(self, data):
+        # Indexing a bytearray yields integers with both Python 2 and 3
+        self.data = bytearray(data)
+        self.pos = 0
+
+    def read_exact(self, size):
+        end = self.pos + size
+        if end > len(self.data):
+            raise ValueError('Truncated snapshot file')
+        result = bytes(self.data[self.pos:end])
+        self.pos = end
+        return result
+
+    def uint(self):
+        result, self.pos = _decode_uint(self.data, self.pos)
+        return result
+
+    def int(self):
+        value = self.uint()
+        return (value >> 1) if not value & 1 else -((value + 1) >> 1)
+
+    def bytes(self):
+        return self.read_exact(self.uint())
+
+    def str(self):
+        size = self.uint()
+        end = self.pos + size
+        if end > len(self.data):
+            raise ValueError('Truncated snapshot file')
+        result = self.data[self.pos:end].decode('utf-8')
+        self.pos = end
+        return result
+
+    def value(self):
+        return self.value_of_kind(self.uint())
+
+    def value_of_kind(self, kind):
+        if kind == _VAL_NONE:
+            return None
+        elif kind == _VAL_INT:
+            return self.int()
+        elif kind == _VAL_STR:
+            return self.str()
+        elif kind == _VAL_DIE_REF:
+            return DIERef(self.uint())
+        elif kind == _VAL_BOOL:
+            return bool(self.uint())
+        elif kind == _VAL_BYTES:
+            return self.bytes()
+        elif kind == _VAL_LIST:
+            return [self.value() for _ in range(self.uint())]
+        elif kind == _VAL_OPAQUE:
+            return Opaque(self.str())
+        else:
+            raise ValueError('Invalid value kind: {}'.format(kind))
+
+    def dies(self, snapshot):
+        """
+        Decode DIE records up to the end record and append them to
+        `snapshot`.
+
+        This is the bulk of loading, so integers are decoded inline, with a
+        fast path for single-byte ones, and so are the most common kinds of
+        values. The others go through value_of_kind.
+        """
+        data = self.data
+        pos = self.pos
+        addresses = snapshot.addresses.append
+        parents = snapshot.parents.append
+        tags = snapshot.tags.append
+        attributes = snapshot.attributes.append
+
+        try:
+            while True:
+                record = data[pos]
+                pos += 1
+                if record == _RECORD_END:
+                    break
+                elif record != _RECORD_DIE:
+                    raise ValueError(
+                        'Invalid record kind: {}'.format(record)
+                    )
+
+                address, pos = _decode_uint(data, pos)
+                addresses(address)
+
+                parent = data[pos]
+                if parent < 0x80:
+                    pos += 1
+                else:
+                    parent, pos = _decode_uint(data, pos)
+                parents(parent - 1)
+
+                tag = data[pos]
+                if tag < 0x80:
+                    pos += 1
+                else:
+                    tag, pos = _decode_uint(data, pos)
+                tags(tag)
+
+                count = data[pos]
+                if count < 0x80:
+                    pos += 1
+                else:
+                    count, pos = _decode_uint(data, pos)
+
+                attrs = []
+                for _ in range(count):
+                    attr = data[pos]
+                    if attr < 0x80:
+                        pos += 1
+                    else:
+                        attr, pos = _decode_uint(data, pos)
+
+                    val_class = data[pos]
+                    if val_class < 0x80:
+                        pos += 1
+                    else:
+                        val_class, pos = _decode_uint(data, pos)
+
+                    # Value kinds are _VAL_* constants: they fit in one byte
+                    kind = data[pos]
+                    pos += 1
+
+                    if kind == _VAL_INT:
+                        value = data[pos]
+                        if value < 0x80:
+                            pos += 1
+                        else:
+                            value, pos = _decode_uint(data, pos)
+                        value = ((value >> 1) if not value & 1 else
+                                 -((value + 1) >> 1))
+                    elif kind == _VAL_STR:
+                        length = data[pos]
+                        if length < 0x80:
+                            pos += 1
+                        else:
+                            length, pos = _decode_uint(data, pos)
+                        end = pos + length
+                        if end > len(data):
+                            raise IndexError
+                        value = data[pos:end].decode('utf-8')
+                        pos = end
+                    elif kind == _VAL_DIE_REF:
+                        value, pos = _decode_uint(data, pos)
+                        value = DIERef(value)
+                    elif kind == _VAL_NONE:
+                        value = None
+                    else:
+                        self.pos = pos
+                        value = self.value_of_kind(kind)
+                        pos = self.pos
+                    attrs.append((attr, val_class, value))
+                attributes(tuple(attrs))
+        except IndexError:
+            raise ValueError('Truncated snapshot file')
+
+        self.pos = pos
+
+
+class DIESnapshot(object):
+    """
+    In-memory, column-oriented DIE tree snapshot.
+
+    DIEs are designated by their index in the snapshot (the root is 0).
+    `addresses`, `parents` (-1 for the root) and `tags` are integer arrays,
+    `attributes` is a list containing, for each DIE, a tuple of (attr,
+    val_class, value) triples.
+    """
+
+    def __init__(self, enum_tables):
+        self.enum_tables = enum_tables
+        self.addresses = array('Q')
+        self.parents = array('q')
+        self.tags = array('L')
+        self.attributes = []
+        self._by_address = None
+        self._children = None
+        self._name_to_int = {}
+
+    def __len__(self):
+        return len(self.tags)
+
+    def enum_name(self, table, value):
+        return self.enum_tables[table].get(value, str(value))
+
+    def enum_value(self, table, name):
+        try:
+            mapping = self._name_to_int[table]
+        except KeyError:
+            mapping = {
+                n: v for v, n in self.enum_tables[table].items()
+            }
+            self._name_to_int[table] = mapping
+        return mapping[name]
+
+    def tag_name(self, index):
+        return self.enum_name('dwarf_tag', self.tags[index])
+
+    def index_of(self, address):
+        """Return the index of the DIE at `address`, or None."""
+        if self._by_address is None:
+            self._by_address = {
+                a: i for i, a in enumerate(self.addresses)
+            }
+        return self._by_address.get(address)
+
+    def resolve(self, ref):
+        """Return the index of the DIE referenced by `ref`, or None."""
+        return self.index_of(ref.address)
+
+    def children(self, index):
+        if self._children is None:
+            self._children = [[] for _ in range(len(self))]
+            for i, p in enumerate(self.parents):
+                if p >= 0:
+                    self._children[p].append(i)
+        return self._children[index]
+
+    def get(self, index, attr_name, default=None):
+        """
+        Return the value of the `attr_name` attribute (e.g. 'DW_AT_name') for
+        the DIE at `index`, or `default` if there is no such attribute.
+        """
+        try:
+            attr = self.enum_value('dwarf_attribute', attr_name)
+        except KeyError:
+            return default
+        for a, _, value in self.attributes[index]:
+            if a == attr:
+                return value
+        return default
+
+    def name(self, index):
+        return self.get(index, 'DW_AT_name')
+
+    def find(self, predicate):
+        """
+        Return the list of indexes of DIEs for which `predicate(snapshot,
+        index)` returns true.
+        """
+        return [i for i in range(len(self)) if predicate(self, i)]
+
+    def depth(self, index):
+        result = 0
+        while self.parents[index] >= 0:
+            index = self.parents[index]
+            result += 1
+        return result
+
+    def format_value(self, value):
+        """
+        Format an attribute value so that it does not depend on compiler
+        addresses: DIE references are turned into snapshot indexes.
+        """
+        if isinstance(value, DIERef):
+            index = self.resolve(value)
+            return ('die #{}'.format(index) if index is not None else
+                    'die <outside snapshot>')
+        elif isinstance(value, list):
+            return '[{}]'.format(', '.join(
+                self.format_value(v) for v in value
+            ))
+        elif isinstance(value, Opaque):
+            return value.text
+        else:
+            return repr(value)
+
+    def dump(self, out):
+        """
+        Write a textual, address-independent form of this snapshot to `out`,
+        suitable for diffing.
+        """
+        # Parents always come before their children, so depths can be
+        # computed in the same pass.
+        depths = array('L')
+        for i in range(len(self)):
+            parent = self.parents[i]
+            depths.append(depths[parent] + 1 if parent >= 0 else 0)
+            indent = '  ' * depths[i]
+            out.write('{}#{} {}\n'.format(indent, i, self.tag_name(i)))
+            for attr, val_class, value in self.attributes[i]:
+                out.write('{}  {} ({}): {}\n'.format(
+                    indent,
+                    self.enum_name('dwarf_attribute', attr),
+                    self.enum_name('dw_val_class', val_class),
+                    self.format_value(value)
+                ))
+
+
+def load(filename):
+    """Load the snapshot file `filename` and return a DIESnapshot."""
+    with io.open(filename, 'rb') as f:
+        reader = _Reader(f.read())
+    if reader.read_exact(len(MAGIC)) != MAGIC:
+        raise ValueError('{}: not a DIE snapshot'.format(filename))
+
+    enum_tables = {}
+    for name in ENUM_TABLES:
+        table = {}
+        for _ in range(reader.uint()):
+            value = reader.uint()
+            table[value] = reader.str()
+        enum_tables[name] = table
+
+    result = DIESnapshot(enum_tables)
+    reader.dies(result)
+    return result
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.stderr.write('Usage: {} SNAPSHOT-FILE\n'.format(sys.argv[0]))
+        sys.exit(1)
+    load(sys.argv[1]).dump(sys.stdout)
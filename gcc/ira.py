@@ -1,14 +1,21 @@
+import json
+import struct
+
 import gdb
 import gdb.types
 
+from gcc.cache import StopCache, lookup_type
 from gcc.cfg import BasicBlock, Loop
-from gcc.utils import iter_frames, ptr_to_int
+from gcc.utils import (
+    int_format, is_string, iter_frames, pointer_size, ptr_to_int,
+    read_memory, read_pointer_array, struct_layout
+)
 
 
 class IRAAllocno(object):
 
     def __init__(self, value):
-        if isinstance(value, basestring):
+        if is_string(value):
             value = gdb.parse_and_eval(value)
 
         if not isinstance(value, gdb.Value):
@@ -50,13 +57,9 @@ class IRAAllocno(object):
     @property
     def color_data(self):
         # Color data is available during the call to ira_color only
-        for frame in iter_frames():
-            if frame.name() == 'ira_color':
-                break
-        else:
-            assert False, 'There is no bucket outside IRA coloring'
+        assert in_ira_color(), 'There is no bucket outside IRA coloring'
 
-        color_data_type = gdb.lookup_type('allocno_color_data').pointer()
+        color_data_type = lookup_type('allocno_color_data').pointer()
         return self.value['add_data'].cast(color_data_type)
 
     @property
@@ -88,10 +91,25 @@ class IRAAllocno(object):
             return 'nullptr'
 
 
+def _compute_in_ira_color(_):
+    return any(frame.name() == 'ira_color' for frame in iter_frames())
+
+
+_in_ira_color = StopCache('in_ira_color', _compute_in_ira_color)
+
+
+def in_ira_color():
+    """
+    Return whether the selected thread is inside ira_color (computed once
+    per stop).
+    """
+    return _in_ira_color[None]
+
+
 class IRAMove(object):
 
     def __init__(self, value):
-        if isinstance(value, basestring):
+        if is_string(value):
             value = gdb.parse_and_eval(value)
 
         if not isinstance(value, gdb.Value):
@@ -140,7 +158,7 @@ class IRAMove(object):
 class IRAObject(object):
 
     def __init__(self, value):
-        if isinstance(value, basestring):
+        if is_string(value):
             value = gdb.parse_and_eval(value)
 
         if not isinstance(value, gdb.Value):
@@ -157,34 +175,80 @@ class IRAObject(object):
     def allocno(self):
         return IRAAllocno(self.value['allocno'])
 
-    def items(self):
-        ira_object_t = gdb.lookup_type('ira_object_t')
+    @property
+    def id(self):
+        return int(self.value['id'])
+
+    def conflict_ids(self):
+        """
+        Return the set of ids for objects conflicting with this one, when
+        conflicts are stored as a bit vector. Return None otherwise.
+        """
         if self.value['conflict_vec_p']:
-            array = self.value['conflicts_array'].cast(ira_object_t)
-            i = 0
-            while array[i]:
-                yield IRAObject(array[i])
-                i += 1
-
+            return None
+        first = int(self.value['min'])
+        last = int(self.value['max'])
+        if last < first:
+            return set()
+
+        # Fetch the whole bit vector at once and turn it into a single
+        # integer: bit N is set iff the object with id first + N conflicts.
+        word_bits = ira_int_bits()
+        word_size = word_bits // 8
+        count = (last - first) // word_bits + 1
+        data = read_memory(ptr_to_int(self.value['conflicts_array']),
+                           count * word_size)
+        if int_format(1).startswith('<'):
+            bits = int.from_bytes(data, 'little')
         else:
-            object_id_map = gdb.parse_and_eval('ira_object_id_map')
-            elt_size = int(gdb.parse_and_eval('IRA_INT_BITS'))
-            elt_type = gdb.lookup_type('uint{}_t'.format(elt_size))
-            bitvec = self.value['conflicts_array'].cast(elt_type.pointer())
-            first = self.value['min']
-            last = self.value['max']
-
-            for i in range(first, last + 1):
-                bit_index = i - first
-                word_index = bit_index / elt_size
-                word_bit_index = word_index * elt_size
-                word = bitvec[word_index]
-                if (word >> word_bit_index) and 1:
-                    yield IRAObject(object_id_map[i])
+            bits = 0
+            words = struct.unpack(int_format(word_size, count=count), data)
+            for i, word in enumerate(words):
+                bits |= word << (i * word_bits)
+
+        result = set()
+        while bits:
+            lowest = bits & -bits
+            result.add(first + lowest.bit_length() - 1)
+            bits ^= lowest
+        return result
+
+    def conflict_addresses(self):
+        """
+        Return the list of addresses for objects conflicting with this one.
+        """
+        if self.value['conflict_vec_p']:
+            # NULL-terminated array of objects
+            size = int(self.value['conflicts_array_size'])
+            ptr_size = pointer_size()
+            if not size:
+                return []
+            data = read_memory(ptr_to_int(self.value['conflicts_array']),
+                               size)
+            result = []
+            for address in struct.unpack(
+                int_format(ptr_size, count=size // ptr_size), data
+            ):
+                if not address:
+                    break
+                result.append(address)
+            return result
+
+        ids = self.conflict_ids()
+        if not ids:
+            return []
+        first = min(ids)
+        id_map = read_object_id_map(first, max(ids))
+        return [id_map[i - first] for i in sorted(ids)]
+
+    def items(self):
+        ira_object_t = lookup_type('ira_object_t')
+        for address in self.conflict_addresses():
+            yield IRAObject(gdb.Value(address).cast(ira_object_t))
 
     def __repr__(self):
         if self.value:
-            return '<IRAObject for allocno {} at {:#x}'.format(
+            return '<IRAObject for allocno {} at {:#x}>'.format(
                 self.allocno.num,
                 ptr_to_int(self.value)
             )
@@ -192,10 +256,30 @@ class IRAObject(object):
             return 'nullptr'
 
 
+def ira_int_bits():
+    """Return the number of bits in IRA bit vector words."""
+    try:
+        return int(gdb.parse_and_eval('IRA_INT_BITS'))
+    except gdb.error:
+        # Macro information is not available: IRA_INT_TYPE is HOST_WIDE_INT,
+        # which is 64-bit on all supported hosts.
+        return 64
+
+
+def read_object_id_map(first, last):
+    """
+    Read the `first` to `last` (included) entries of `ira_object_id_map`
+    with a single memory read and return them as a list of addresses.
+    """
+    id_map = ptr_to_int(gdb.parse_and_eval('ira_object_id_map'))
+    return read_pointer_array(id_map + first * pointer_size(),
+                              last - first + 1)
+
+
 class IRALoopTreeNode(object):
 
     def __init__(self, value):
-        if isinstance(value, basestring):
+        if is_string(value):
             value = gdb.parse_and_eval(value)
 
         if not isinstance(value, gdb.Value):
@@ -257,45 +341,93 @@ class IRALoopTreeNode(object):
             content, addr
         )
 
-    def repr_tree(self):
-        result = []
+    def capture_tree(self):
+        """
+        Return the loop tree rooted at this node as plain Python records
+        (see capture_loop_tree), captured at most once per stop.
+        """
+        return loop_tree_records[ptr_to_int(self.value)]
+
+    def repr_tree(self, as_json=False):
+        """
+        Return a textual representation of the loop tree rooted at this node.
+        If `as_json` is true, return a JSON document instead.
+        """
+        record = self.capture_tree()
+        if as_json:
+            return json.dumps(record, indent=2)
 
-        def handle_node(node, indent):
-            children = node.children_list
-            if children:
-                bb_children = []
-                loop_children = []
-                for c in children:
-                    if c.bb:
-                        bb_children.append(c)
-                    else:
-                        loop_children.append(c)
-                bb_children.sort(key=lambda c: c.bb.index)
-                loop_children.sort(key=lambda c: c.loop.num)
-
-                result.append('{}Loop {}({:#x}): '.format(
-                    indent, node.loop.num,
-                    ptr_to_int(node.value)
-                ))
-                if bb_children:
-                    result.append("BB's ")
-                for i, c in enumerate(bb_children):
-                    if i > 0:
-                        result.append(', ')
-                    result.append('{}({:#x})'.format(c.bb.index,
-                                                     ptr_to_int(node.value)))
-                result.append('\n')
-                for c in loop_children:
-                    handle_node(c, indent + '  ')
-            else:
-                result.append('(no loop) BB {}({:#x})'.format(
-                    node.bb.index, ptr_to_int(node.value)
+        result = []
+        worklist = [(record, '')]
+        while worklist:
+            node, indent = worklist.pop()
+            if node['bb'] is not None:
+                result.append('{}(no loop) BB {}({:#x})\n'.format(
+                    indent, node['bb'], node['address']
                 ))
+                continue
 
-        handle_node(self, '')
+            bb_children = sorted(
+                (c for c in node['children'] if c['bb'] is not None),
+                key=lambda c: c['bb']
+            )
+            loop_children = sorted(
+                (c for c in node['children'] if c['bb'] is None),
+                key=lambda c: c['loop']
+            )
+            result.append('{}Loop {}({:#x}): '.format(
+                indent, node['loop'], node['address']
+            ))
+            if bb_children:
+                result.append("BB's ")
+                result.append(', '.join(
+                    '{}({:#x})'.format(c['bb'], c['address'])
+                    for c in bb_children
+                ))
+            result.append('\n')
+            for c in reversed(loop_children):
+                worklist.append((c, indent + '  '))
         return ''.join(result)
 
 
+def capture_loop_tree(address):
+    """
+    Read the IRA loop tree rooted at `address` with raw memory reads and
+    return it as nested dicts with "address", "bb" (block index or None),
+    "loop" (loop number or None) and "children" keys.
+    """
+    node_layout = struct_layout('ira_loop_tree_node_t', 'bb', 'loop',
+                                'children', 'next')
+    bb_layout = struct_layout('basic_block', 'index')
+    loop_layout = struct_layout('loop_p', 'num')
+
+    def make_record(node_address):
+        fields = node_layout.decode(node_address)
+        record = {
+            'address': node_address,
+            'bb': (bb_layout.decode(fields['bb'])['index']
+                   if fields['bb'] else None),
+            'loop': (loop_layout.decode(fields['loop'])['num']
+                     if fields['loop'] else None),
+            'children': [],
+        }
+        return record, fields
+
+    root, root_fields = make_record(address)
+    worklist = [(root, root_fields['children'])]
+    while worklist:
+        record, child = worklist.pop()
+        while child:
+            child_record, child_fields = make_record(child)
+            record['children'].append(child_record)
+            worklist.append((child_record, child_fields['children']))
+            child = child_fields['next']
+    return root
+
+
+loop_tree_records = StopCache('ira_loop_trees', capture_loop_tree)
+
+
 class IRAAllocnoPrinter(object):
     name = 'ira_allocno'
 
@@ -317,16 +449,357 @@ class IRAMovePrinter(object):
 
 
 def allocnos_for_regno(regno):
-    allocnos = gdb.parse_and_eval('ira_allocnos')
+    return [r.allocno for r in AllocnoIndex.get().by_regno.get(regno, [])]
+
+
+class AllocnoRecord(object):
+    """Plain data decoded for one allocno."""
+
+    __slots__ = ('address', 'num', 'regno', 'hard_regno', 'loop_tree_node',
+                 'objects')
+
+    def __init__(self, address, num, regno, hard_regno, loop_tree_node,
+                 objects):
+        self.address = address
+        self.num = num
+        self.regno = regno
+        self.hard_regno = hard_regno
+        self.loop_tree_node = loop_tree_node
+        self.objects = objects
+
+    @property
+    def allocno(self):
+        return IRAAllocno(
+            gdb.Value(self.address).cast(lookup_type('ira_allocno_t'))
+        )
+
+    def __repr__(self):
+        return '<AllocnoRecord {} reg:{} hardreg:{} at {:#x}>'.format(
+            self.num, self.regno, self.hard_regno, self.address
+        )
+
+
+def read_allocno_records():
+    """
+    Read all allocnos in `ira_allocnos`: fetch the pointer array with one
+    memory read, then decode each allocno structure with one raw read.
+    Return a list of AllocnoRecord (NULL entries are skipped).
+    """
+    allocnos = ptr_to_int(gdb.parse_and_eval('ira_allocnos'))
     count = int(gdb.parse_and_eval('ira_allocnos_num'))
+    if not allocnos:
+        return []
+    layout = struct_layout('ira_allocno_t', 'num', 'regno', 'hard_regno',
+                           'loop_tree_node', 'num_objects', 'objects')
     result = []
-
-    for i in range(count):
-        a = allocnos[i]
-        if not a:
+    for address in read_pointer_array(allocnos, count):
+        if not address:
             continue
+        fields = layout.decode(address)
+        result.append(AllocnoRecord(
+            address, fields['num'], fields['regno'], fields['hard_regno'],
+            fields['loop_tree_node'],
+            fields['objects'][:fields['num_objects']]
+        ))
+    return result
+
+
+class AllocnoIndex(object):
+    """
+    Lookup tables for all allocnos, built from read_allocno_records: by
+    `num`, lists by `regno`, `hard_regno` and loop tree node address, and
+    allocno numbers by object address (`owners`).
+    """
+
+    def __init__(self):
+        self.records = read_allocno_records()
+        self.by_num = {}
+        self.by_regno = {}
+        self.by_hard_regno = {}
+        self.by_loop_tree_node = {}
+        self.owners = {}
+        for r in self.records:
+            self.by_num[r.num] = r
+            self.by_regno.setdefault(r.regno, []).append(r)
+            self.by_hard_regno.setdefault(r.hard_regno, []).append(r)
+            self.by_loop_tree_node.setdefault(r.loop_tree_node, []).append(r)
+            for obj in r.objects:
+                self.owners[obj] = r.num
+
+    @classmethod
+    def get(cls):
+        """Return the allocno index, built at most once per stop."""
+        return allocno_indexes[None]
+
+
+allocno_indexes = StopCache('ira_allocno_indexes', lambda _: AllocnoIndex())
+
+
+def allocno_for_num(num):
+    record = AllocnoIndex.get().by_num.get(num)
+    return record.allocno if record else None
+
+
+def allocnos_for_hard_regno(hard_regno):
+    return [r.allocno
+            for r in AllocnoIndex.get().by_hard_regno.get(hard_regno, [])]
+
+
+def allocnos_for_loop_tree_node(node):
+    """
+    Return allocnos for the `node` loop tree node (an IRALoopTreeNode, a
+    gdb.Value or an address).
+    """
+    if isinstance(node, IRALoopTreeNode):
+        node = node.value
+    if isinstance(node, gdb.Value):
+        node = ptr_to_int(node)
+    return [r.allocno
+            for r in AllocnoIndex.get().by_loop_tree_node.get(node, [])]
+
+
+def conflicting_allocnos(record):
+    """
+    Return the set of numbers for allocnos that conflict with the `record`
+    AllocnoRecord. Only the conflicts of its own objects are read: use
+    ConflictGraph to get the conflicts of all allocnos at once.
+    """
+    owners = AllocnoIndex.get().owners
+    ira_object_t = lookup_type('ira_object_t')
+    result = set()
+    for obj in record.objects:
+        obj = IRAObject(gdb.Value(obj).cast(ira_object_t))
+        for address in obj.conflict_addresses():
+            owner = owners.get(address)
+            if owner is not None and owner != record.num:
+                result.add(owner)
+    return result
+
+
+class ConflictGraph(object):
+    """
+    Whole IRA conflict graph: `adjacency` maps each allocno number to the set
+    of numbers for allocnos it conflicts with.
+    """
+
+    def __init__(self):
+        self.allocnos = dict(AllocnoIndex.get().by_num)
+        self.adjacency = {num: set() for num in self.allocnos}
+
+        obj_layout = struct_layout('ira_object_t', 'id')
+        ira_object_t = lookup_type('ira_object_t')
+        owner_by_address = {}
+        owner_by_id = {}
+        for record in self.allocnos.values():
+            for obj in record.objects:
+                owner_by_address[obj] = record.num
+                owner_by_id[obj_layout.decode(obj)['id']] = record.num
+
+        for record in self.allocnos.values():
+            neighbors = self.adjacency[record.num]
+            for obj in record.objects:
+                obj = IRAObject(gdb.Value(obj).cast(ira_object_t))
+                ids = obj.conflict_ids()
+                if ids is None:
+                    owners = [owner_by_address.get(a)
+                              for a in obj.conflict_addresses()]
+                else:
+                    owners = [owner_by_id.get(i) for i in ids]
+                for owner in owners:
+                    if owner is not None and owner != record.num:
+                        neighbors.add(owner)
+                        self.adjacency[owner].add(record.num)
+
+    @classmethod
+    def get(cls):
+        """Return the conflict graph, captured at most once per stop."""
+        return conflict_graphs[None]
+
+    def degree(self, num):
+        return len(self.adjacency[num])
+
+    def neighbors(self, num):
+        return sorted(self.adjacency[num])
+
+    def common_neighbors(self, *nums):
+        """Return allocnos that conflict with all allocnos in `nums`."""
+        if not nums:
+            return []
+        result = set(self.adjacency[nums[0]])
+        for num in nums[1:]:
+            result &= self.adjacency[num]
+        return sorted(result)
+
+    def max_degree(self, count=1):
+        """Return the `count` (num, degree) couples with the max degree."""
+        return sorted(
+            ((num, len(n)) for num, n in self.adjacency.items()),
+            key=lambda item: (-item[1], item[0])
+        )[:count]
+
+    def stats(self):
+        """Return a dict with degree statistics."""
+        degrees = sorted(len(n) for n in self.adjacency.values())
+        if not degrees:
+            return {'allocnos': 0, 'edges': 0}
+        return {
+            'allocnos': len(degrees),
+            'edges': sum(degrees) // 2,
+            'min': degrees[0],
+            'max': degrees[-1],
+            'mean': float(sum(degrees)) / len(degrees),
+            'median': degrees[len(degrees) // 2],
+        }
+
+    def export(self, filename):
+        """
+        Write the graph to `filename`: in the Graphviz format if it ends with
+        ".dot", as a list of "A B" edges (one per line) otherwise.
+        """
+        dot = filename.endswith('.dot')
+        with open(filename, 'w') as f:
+            if dot:
+                f.write('graph conflicts {\n')
+                for num in sorted(self.allocnos):
+                    r = self.allocnos[num]
+                    f.write('a{} [label="a{} r{}"];\n'.format(
+                        num, num, r.regno
+                    ))
+            for num in sorted(self.adjacency):
+                for other in sorted(self.adjacency[num]):
+                    if other > num:
+                        f.write(('a{} -- a{};\n' if dot else '{} {}\n')
+                                .format(num, other))
+            if dot:
+                f.write('}\n')
+
+    def __repr__(self):
+        return '<ConflictGraph: {allocnos} allocnos, {edges} edges>'.format(
+            **self.stats()
+        )
+
+
+conflict_graphs = StopCache('ira_conflict_graphs', lambda _: ConflictGraph())
+
+
+class ConflictGraphCommand(gdb.Command):
+    """
+    Query the IRA conflict graph (captured once per stop).
+
+    Usage: gcc-ira-conflicts stats
+           gcc-ira-conflicts max-degree [COUNT]
+           gcc-ira-conflicts neighbors ALLOCNO-NUM
+           gcc-ira-conflicts common ALLOCNO-NUM...
+           gcc-ira-conflicts export FILE
+    """
+
+    def __init__(self, name='gcc-ira-conflicts'):
+        super(ConflictGraphCommand, self).__init__(name, gdb.COMMAND_DATA)
+        self.name = name
+
+    def invoke(self, arg, from_tty):
+        argv = gdb.string_to_argv(arg)
+        if not argv:
+            raise gdb.GdbError('Missing sub-command, see help {}'.format(
+                self.name
+            ))
+        cmd, args = argv[0], argv[1:]
+        try:
+            nums = [int(a, 0) for a in args] if cmd != 'export' else []
+        except ValueError:
+            raise gdb.GdbError('Allocno numbers expected')
+        graph = ConflictGraph.get()
+
+        def check_nums():
+            for num in nums:
+                if num not in graph.adjacency:
+                    raise gdb.GdbError('No such allocno: {}'.format(num))
+
+        if cmd == 'stats':
+            for key, value in sorted(graph.stats().items()):
+                gdb.write('{}: {}\n'.format(key, value))
+        elif cmd == 'max-degree':
+            for num, degree in graph.max_degree(nums[0] if nums else 1):
+                gdb.write('{}: {}\n'.format(graph.allocnos[num], degree))
+        elif cmd == 'neighbors' and len(nums) == 1:
+            check_nums()
+            for num in graph.neighbors(nums[0]):
+                gdb.write('{}\n'.format(graph.allocnos[num]))
+        elif cmd == 'common' and nums:
+            check_nums()
+            for num in graph.common_neighbors(*nums):
+                gdb.write('{}\n'.format(graph.allocnos[num]))
+        elif cmd == 'export' and len(args) == 1:
+            graph.export(args[0])
+        else:
+            raise gdb.GdbError('Invalid arguments, see help {}'.format(
+                self.name
+            ))
+
+
+BUCKETS = ('colorable_allocno_bucket', 'uncolorable_allocno_bucket')
+
 
-        if int(a['regno']) == regno:
-            result.append(IRAAllocno(a))
+def read_bucket(name):
+    """
+    Read the `name` coloring bucket and return the list of (AllocnoRecord,
+    fields) couples for its allocnos, where `fields` is a dict with cost
+    and frequency information.
+    """
+    if not in_ira_color():
+        raise gdb.GdbError('There is no bucket outside IRA coloring')
+    try:
+        head = gdb.parse_and_eval(name)
+    except gdb.error:
+        head = gdb.parse_and_eval("'ira-color.c'::{}".format(name))
 
+    index = AllocnoIndex.get()
+    by_address = {r.address: r for r in index.records}
+    allocno_layout = struct_layout('ira_allocno_t', 'add_data', 'class_cost',
+                                   'memory_cost', 'freq')
+    color_layout = struct_layout('allocno_color_data', 'next_bucket_allocno')
+
+    result = []
+    address = ptr_to_int(head)
+    while address:
+        fields = allocno_layout.decode(address)
+        result.append((by_address.get(address), fields))
+        address = (color_layout.decode(fields['add_data'])
+                   ['next_bucket_allocno'])
     return result
+
+
+class BucketCommand(gdb.Command):
+    """
+    Dump IRA coloring buckets with costs and conflict counts.
+
+    Usage: gcc-ira-buckets [colorable|uncolorable]
+
+    Only available while inside ira_color.
+    """
+
+    def __init__(self, name='gcc-ira-buckets'):
+        super(BucketCommand, self).__init__(name, gdb.COMMAND_DATA)
+
+    def invoke(self, arg, from_tty):
+        arg = arg.strip()
+        if arg not in ('', 'colorable', 'uncolorable'):
+            raise gdb.GdbError('Usage: gcc-ira-buckets'
+                               ' [colorable|uncolorable]')
+        for bucket in BUCKETS:
+            if arg and not bucket.startswith(arg + '_'):
+                continue
+            entries = read_bucket(bucket)
+            gdb.write('{} ({} allocnos):\n'.format(bucket, len(entries)))
+            for record, fields in entries:
+                if record is None:
+                    gdb.write('  <unknown allocno>\n')
+                    continue
+                gdb.write(
+                    '  a{} r{} class_cost:{} memory_cost:{} freq:{}'
+                    ' conflicts:{}\n'.format(
+                        record.num, record.regno, fields['class_cost'],
+                        fields['memory_cost'], fields['freq'],
+                        len(conflicting_allocnos(record))
+                    )
+                )
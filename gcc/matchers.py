@@ -1,6 +1,10 @@
 import gdb
 
-from gcc.tree import Tree, tree_code
+from gcc.cache import lookup_type
+from gcc.tree import (
+    Tree, read_identifier_string, read_name_identifier, read_tree_code
+)
+from gcc.utils import ptr_to_int
 
 
 class MatchTree(gdb.Function):
@@ -8,25 +12,96 @@ class MatchTree(gdb.Function):
     Return whether a GCC tree matches expected tree code and name.
 
     For instance: matchtree(node, RECORD_TYPE, "foobar")
+
+    This is meant to be used in conditions for breakpoints that are hit very
+    often, so it reads the inferior memory directly instead of going through
+    Tree wrappers.
     """
 
     def __init__(self, name='matchtree'):
         super(MatchTree, self).__init__(name)
 
+        # For each name this function was called with, address of the
+        # matching IDENTIFIER_NODE, once found. GCC creates only one
+        # identifier per string, so other trees can then be matched just by
+        # comparing identifier addresses. Addresses are only valid for the
+        # current process.
+        self.identifiers = {}
+        gdb.events.exited.connect(self.clear_identifiers)
+        gdb.events.new_objfile.connect(self.clear_identifiers)
+
+    def clear_identifiers(self, event=None):
+        self.identifiers.clear()
+
     def invoke(self, value, code, name):
-        name = name.string() if name else None
-        tree = Tree(value)
-        if not tree or tree.code != code:
+        address = ptr_to_int(value)
+        if not address:
+            return False
+
+        tree_code = read_tree_code(address)
+        if tree_code != int(code):
             return False
 
         if not name:
             return True
 
-        if tree.code == tree_code.IDENTIFIER_NODE:
-            tree_name = tree.identifier_string
-        else:
-            try:
-                tree_name = tree.name
-            except ValueError:
-                tree_name = None
-        return tree_name == name
+        try:
+            identifier = read_name_identifier(address, tree_code)
+        except ValueError:
+            return False
+        if not identifier:
+            return False
+
+        name = name.string()
+        expected = self.identifiers.get(name)
+        if expected is not None:
+            return identifier == expected
+        if read_identifier_string(identifier) != name:
+            return False
+        self.identifiers[name] = identifier
+        return True
+
+
+class FindTree(gdb.Function):
+    """
+    Return a GCC tree with the given name, or NULL_TREE if there is none.
+
+    For instance: findtree("foo"), or findtree("foo", 1) to get the second
+    match. Declarations in the current function come first, then the
+    IDENTIFIER_NODE. Use the gcc-find-tree command to list all matches.
+    """
+
+    def __init__(self, name='findtree'):
+        super(FindTree, self).__init__(name)
+
+    def invoke(self, name, index=0):
+        matches = Tree.lookup_name(name.string())
+        index = int(index)
+        if 0 <= index < len(matches):
+            return matches[index].value
+        return gdb.Value(0).cast(lookup_type('tree'))
+
+
+class FindTreeCommand(gdb.Command):
+    """
+    List GCC trees with the given name.
+
+    Usage: gcc-find-tree NAME
+
+    Look for declarations in the current function (arguments and variables
+    in its BLOCK tree) and for the corresponding IDENTIFIER_NODE. The index
+    used for the lookup is built once per stop.
+    """
+
+    def __init__(self, name='gcc-find-tree'):
+        super(FindTreeCommand, self).__init__(name, gdb.COMMAND_USER)
+
+    def invoke(self, arg, from_tty):
+        argv = gdb.string_to_argv(arg)
+        if len(argv) != 1:
+            raise gdb.GdbError('Usage: gcc-find-tree NAME')
+        matches = Tree.lookup_name(argv[0])
+        if not matches:
+            gdb.write('No tree named {}\n'.format(argv[0]))
+        for i, tree in enumerate(matches):
+            gdb.write('[{}] {}\n'.format(i, tree))
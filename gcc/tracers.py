@@ -1,6 +1,23 @@
+from collections import deque
+import io
+import json
+import re
+import time
+
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+
 import gdb
 
 from gcc.tree import Tree
+from gcc.utils import ptr_to_int
+
+
+def frame_sp(frame):
+    """Return the value of the stack pointer in `frame`, as an integer."""
+    return ptr_to_int(frame.read_register('sp'))
 
 
 def iter_frames(start=None):
@@ -12,22 +29,148 @@ def iter_frames(start=None):
         start = start.older()
 
 
+class TraceEvent(object):
+    """One line of trace."""
+
+    __slots__ = ('timestamp', 'depth', 'spec', 'data')
+
+    def __init__(self, timestamp, depth, spec, data):
+        self.timestamp = timestamp
+        self.depth = depth
+        self.spec = spec
+        self.data = data
+
+    def format(self):
+        data_suffix = ' ({})'.format(self.data) if self.data else ''
+        return '{}{}{}'.format('  ' * self.depth, self.spec, data_suffix)
+
+    def as_dict(self):
+        return {'timestamp': self.timestamp, 'depth': self.depth,
+                'spec': self.spec, 'data': self.data}
+
+
+class GDBSink(object):
+    """Write trace events to the GDB console as soon as they happen."""
+
+    def write(self, event):
+        gdb.write(event.format() + '\n')
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __repr__(self):
+        return '<GDBSink>'
+
+
+class RingBufferSink(object):
+    """Keep the last `size` trace events in memory."""
+
+    def __init__(self, size=100000):
+        self.events = deque(maxlen=size)
+
+    def write(self, event):
+        self.events.append(event)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __repr__(self):
+        return '<RingBufferSink {}/{} events>'.format(
+            len(self.events), self.events.maxlen
+        )
+
+
+class FileSink(object):
+    """Write trace events as text lines to a buffered file."""
+
+    buffer_size = 1 << 20
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = io.open(filename, 'w', buffering=self.buffer_size,
+                            encoding='utf-8')
+
+    def format(self, event):
+        return event.format()
+
+    def write(self, event):
+        self.file.write(u'{}\n'.format(self.format(event)))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __repr__(self):
+        return '<{} {}>'.format(type(self).__name__, self.filename)
+
+
+class JSONLinesSink(FileSink):
+    """Write trace events as JSON objects, one per line."""
+
+    def format(self, event):
+        return json.dumps(event.as_dict())
+
+
+# Sink for all tracers and the last ring buffer used, so that it can still be
+# inspected after switching to another sink.
+current_sink = GDBSink()
+last_ring_buffer = None
+
+
+def set_sink(sink):
+    global current_sink, last_ring_buffer
+    current_sink.close()
+    current_sink = sink
+    if isinstance(sink, RingBufferSink):
+        last_ring_buffer = sink
+
+
+def flush_sink(event=None):
+    current_sink.flush()
+
+
 class Tracer(object):
     def __init__(self):
-        self.points_of_interest = []
+        self.points_of_interest = set()
         self.breakpoints = []
         self.enabled = False
 
-    def add_breakpoint(self, spec, expr=None):
-        bp = LocationDescriptionBreakpoint(spec, self, expr)
+        # Stack pointers for the frames of calls to points of interest that
+        # are currently active, outermost first. Calls that returned are
+        # detected and popped on the next hit, so that trace indentation
+        # requires neither walking the stack nor finish breakpoints.
+        self.active_calls = []
+        self.depth = 0
+
+    def add_breakpoint(self, spec, expr=None, condition=None, every=1):
+        bp = TracerBreakpoint(spec, self, expr, condition, every)
         bp.enabled = self.enabled
-        self.points_of_interest.append(spec)
+        self.points_of_interest.add(spec)
         self.breakpoints.append(bp)
+        return bp
+
+    def remove_breakpoint(self, spec):
+        to_remove = [bp for bp in self.breakpoints if bp.spec == spec]
+        if not to_remove:
+            raise ValueError('No tracepoint for {}'.format(spec))
+        for bp in to_remove:
+            self.breakpoints.remove(bp)
+            bp.delete()
+        self.points_of_interest.discard(spec)
 
     def set_enabling_state(self, state):
         self.enabled = state
         for bp in self.breakpoints:
             bp.enabled = state
+        self.reset_depth()
 
     def enable(self):
         self.set_enabling_state(True)
@@ -36,43 +179,186 @@ class Tracer(object):
         self.set_enabling_state(False)
 
     def is_frame_of_interest(self, frame):
-        func_name = frame.name()
-        for point in self.points_of_interest:
-            if point in func_name:
-                return True
-        return False
+        return frame.name() in self.points_of_interest
+
+    def reset_depth(self):
+        # Calls that are already active when tracing starts are tracked like
+        # the ones that will be hit, so that they are popped when they
+        # return.
+        self.active_calls = []
+        if self.enabled:
+            try:
+                self.active_calls = [
+                    frame_sp(frame) for frame in iter_frames()
+                    if self.is_frame_of_interest(frame)
+                ]
+            except (gdb.error, ValueError):
+                # No frame: the inferior is not running yet
+                pass
+            self.active_calls.reverse()
+        self.depth = len(self.active_calls)
+
+    def enter(self):
+        """
+        Track the call to a point of interest in the newest frame and update
+        the depth accordingly. Return whether tracking succeeded.
+        """
+        try:
+            frame = gdb.newest_frame()
+            sp = frame_sp(frame)
+            caller = frame.older()
+            caller_sp = frame_sp(caller) if caller else None
+        except (gdb.error, ValueError):
+            return False
+
+        # Active calls are ancestors of the new one, so their stack pointer
+        # cannot be lower than the one of its caller (stacks grow downwards):
+        # the other calls have returned.
+        active_calls = self.active_calls
+        if caller_sp is None:
+            del active_calls[:]
+        else:
+            while active_calls and active_calls[-1] < caller_sp:
+                active_calls.pop()
+        active_calls.append(sp)
+        self.depth = len(active_calls)
+        return True
 
     def add_trace(self, spec, data=None):
-        level = len(list(
-            frame
-            for frame in iter_frames()
-            if self.is_frame_of_interest(frame)
-        ))
-        data_suffix = ' ({})'.format(data) if data else ''
-        gdb.write('{}{}{}\n'.format(
-            '  ' * level, spec, data_suffix
+        # Render data right away: it may describe inferior state that will
+        # be gone when the sink is flushed.
+        current_sink.write(TraceEvent(
+            time.time(), self.depth, spec,
+            str(data) if data is not None else None
         ))
 
 
-class LocationDescriptionBreakpoint(gdb.Breakpoint):
+class FrameVariables(object):
+    """
+    Mapping used as the local namespace for tracepoint expressions: names
+    that are not Python globals or builtins resolve to variables in `frame`.
+    Frame variables that have the same name as a Python global or builtin
+    are available through the "var" global: var("len").
+    """
 
-    def __init__(self, spec, tracer, expr_computer=None):
-        super(LocationDescriptionBreakpoint, self).__init__(
-            spec, internal=True,
-        )
+    def __init__(self, frame):
+        self.frame = frame
+        self.cache = {}
+
+    def __getitem__(self, name):
+        # Let Python resolve its own names first, without trying to read a
+        # frame variable each time.
+        if name in expr_globals or hasattr(builtins, name):
+            raise KeyError(name)
+        try:
+            return self.cache[name]
+        except KeyError:
+            pass
+        try:
+            result = self.frame.read_var(name)
+        except ValueError:
+            raise KeyError(name)
+        self.cache[name] = result
+        return result
+
+
+# Globals available to tracepoint expressions
+expr_globals = {
+    'gdb': gdb,
+    'Tree': Tree,
+    'var': lambda name: gdb.selected_frame().read_var(name),
+}
+
+
+def compile_expr(expr, kind):
+    """
+    Compile a tracepoint Python expression once, so that hits only pay for
+    its evaluation.
+    """
+    try:
+        return compile(expr, '<gcc-trace {}>'.format(kind), 'eval')
+    except SyntaxError as exc:
+        raise gdb.GdbError('Invalid {} expression: {}'.format(kind, exc))
+
+
+class TracerBreakpoint(gdb.Breakpoint):
+    """
+    Breakpoint that adds a trace and never stops the inferior.
+
+    `expr_computer` is either a callable or a compiled expression that
+    returns the data to trace. `condition` is a compiled expression: when
+    provided, only hits for which it evaluates to true are traced. If
+    `every` is greater than 1, only one hit out of `every` is considered.
+    """
+
+    def __init__(self, spec, tracer, expr_computer=None, condition=None,
+                 every=1):
+        super(TracerBreakpoint, self).__init__(spec, internal=True)
         self.spec = spec
         self.tracer = tracer
         self.expr_computer = expr_computer
+        self.condition = condition
+        self.every = every
+
+        self.hits = 0
+        self.traced = 0
+        self.time_spent = 0.0
+        self.errors = 0
+
+    def report_error(self, kind, exc):
+        # Report only the first error: this runs on every hit, and stopping
+        # the inferior is not an option.
+        self.errors += 1
+        if self.errors == 1:
+            gdb.write('{}: cannot evaluate {}: {}: {} (further errors are'
+                      ' not reported)\n'.format(
+                          self.spec, kind, type(exc).__name__, exc
+                      ))
+
+    def evaluate(self, code, namespace):
+        if callable(code):
+            return code()
+        return eval(code, expr_globals, namespace)
 
     def stop(self):
-        data = None
-        if self.expr_computer:
-            try:
-                data = self.expr_computer()
-            except gdb.error as exc:
-                data = '<{}: {}>'.format(type(exc), exc)
-        self.tracer.add_trace(self.spec, data)
-        return False
+        # Track all calls, even the ones that are not traced, so that the
+        # depth stays accurate.
+        self.tracer.enter()
+
+        self.hits += 1
+        if self.hits % self.every:
+            return False
+
+        start = time.time()
+        try:
+            namespace = None
+            if self.condition or not callable(self.expr_computer):
+                try:
+                    namespace = FrameVariables(gdb.selected_frame())
+                except gdb.error as exc:
+                    self.report_error('frame', exc)
+                    return False
+
+            if self.condition:
+                try:
+                    if not self.evaluate(self.condition, namespace):
+                        return False
+                except Exception as exc:
+                    self.report_error('condition', exc)
+                    return False
+
+            data = None
+            if self.expr_computer:
+                try:
+                    data = self.evaluate(self.expr_computer, namespace)
+                except Exception as exc:
+                    self.report_error('data', exc)
+                    data = '<{}: {}>'.format(type(exc).__name__, exc)
+            self.tracer.add_trace(self.spec, data)
+            self.traced += 1
+            return False
+        finally:
+            self.time_spent += time.time() - start
 
 
 class LocationDescriptionTracer(gdb.Command):
@@ -104,3 +390,185 @@ class LocationDescriptionTracer(gdb.Command):
                 raise gdb.GdbError(
                     'Traces for {} are not enabled yet'.format(self.name))
             self.tracer.disable()
+
+
+class TraceSinkCommand(gdb.Command):
+    """
+    Select where tracers send their output.
+
+    Usage: gcc-trace-sink gdb
+           gcc-trace-sink ring [SIZE]
+           gcc-trace-sink file FILE
+           gcc-trace-sink json FILE
+
+    "gdb" writes to the console as events happen (the default), "ring" keeps
+    the last SIZE events in memory (see gcc-trace-buffer), "file" writes
+    text lines to a buffered file and "json" writes JSON lines with
+    timestamps. Buffers are flushed when the inferior stops or exits.
+    Without argument, print the current sink.
+    """
+
+    def __init__(self, name='gcc-trace-sink'):
+        super(TraceSinkCommand, self).__init__(name, gdb.COMMAND_USER)
+        gdb.events.stop.connect(flush_sink)
+        gdb.events.exited.connect(flush_sink)
+        self.name = name
+
+    def invoke(self, arg, from_tty):
+        argv = gdb.string_to_argv(arg)
+        if not argv:
+            gdb.write('{}\n'.format(current_sink))
+            return
+        kind, args = argv[0], argv[1:]
+        if kind == 'gdb' and not args:
+            set_sink(GDBSink())
+        elif kind == 'ring' and len(args) <= 1:
+            try:
+                set_sink(RingBufferSink(*[int(a) for a in args]))
+            except ValueError:
+                raise gdb.GdbError('Invalid ring buffer size')
+        elif kind == 'file' and len(args) == 1:
+            set_sink(FileSink(args[0]))
+        elif kind == 'json' and len(args) == 1:
+            set_sink(JSONLinesSink(args[0]))
+        else:
+            raise gdb.GdbError('Invalid arguments, see help {}'.format(
+                self.name
+            ))
+
+
+class TraceBufferCommand(gdb.Command):
+    """
+    Page through the trace ring buffer.
+
+    Usage: gcc-trace-buffer [--grep REGEX] [--spec FUNCTION] [START [COUNT]]
+
+    Print COUNT events (default: 50) starting at the START'th one (default:
+    0) among the events that match the filters. Negative START values count
+    from the end of the buffer.
+    """
+
+    def __init__(self, name='gcc-trace-buffer'):
+        super(TraceBufferCommand, self).__init__(name, gdb.COMMAND_USER)
+
+    def invoke(self, arg, from_tty):
+        if last_ring_buffer is None:
+            raise gdb.GdbError('No ring buffer: use gcc-trace-sink ring')
+
+        argv = gdb.string_to_argv(arg)
+        regex = None
+        spec = None
+        positional = []
+        while argv:
+            a = argv.pop(0)
+            if a in ('--grep', '--spec') and argv:
+                if a == '--grep':
+                    regex = re.compile(argv.pop(0))
+                else:
+                    spec = argv.pop(0)
+            else:
+                try:
+                    positional.append(int(a))
+                except ValueError:
+                    raise gdb.GdbError('Invalid argument: {}'.format(a))
+        start = positional[0] if positional else 0
+        count = positional[1] if len(positional) > 1 else 50
+
+        events = [
+            (i, e) for i, e in enumerate(last_ring_buffer.events)
+            if (spec is None or e.spec == spec) and
+            (regex is None or regex.search(e.format()))
+        ]
+        for i, event in events[start:][:count]:
+            gdb.write('[{}] {}\n'.format(i, event.format()))
+        gdb.write('({} matching events)\n'.format(len(events)))
+
+
+class TraceCommand(gdb.Command):
+    """
+    Trace calls to arbitrary functions.
+
+    Usage: gcc-trace add FUNCTION [--if EXPR] [--data EXPR] [--every N]
+           gcc-trace remove FUNCTION
+           gcc-trace on|off
+           gcc-trace stats
+
+    EXPR are Python expressions, compiled once, in which names refer to
+    variables of the traced frame (gdb.Value instances), except for Python
+    builtins; "gdb", "Tree" and "var" (var("len") reads the "len" variable)
+    are also available. For instance:
+
+        gcc-trace add gen_variable_die --if "Tree(decl).name == 'a'"
+        gcc-trace add type_byte_size --data "Tree(type)"
+
+    With --every N, only one call out of N is considered, which reduces the
+    overhead of tracing very hot functions. "stats" prints, for each
+    function, the number of hits, the number of traced calls and the time
+    spent evaluating tracepoints.
+    """
+
+    def __init__(self, name='gcc-trace'):
+        super(TraceCommand, self).__init__(name, gdb.COMMAND_USER)
+        self.name = name
+        self.tracer = Tracer()
+
+    def invoke(self, arg, from_tty):
+        argv = gdb.string_to_argv(arg)
+        if not argv:
+            raise gdb.GdbError('Missing sub-command, see help {}'.format(
+                self.name
+            ))
+        cmd, args = argv[0], argv[1:]
+
+        if cmd == 'add':
+            self.add(args)
+        elif cmd == 'remove' and len(args) == 1:
+            try:
+                self.tracer.remove_breakpoint(args[0])
+            except ValueError as exc:
+                raise gdb.GdbError(str(exc))
+        elif cmd == 'on' and not args:
+            self.tracer.enable()
+        elif cmd == 'off' and not args:
+            self.tracer.disable()
+        elif cmd == 'stats' and not args:
+            self.print_stats()
+        else:
+            raise gdb.GdbError('Invalid arguments, see help {}'.format(
+                self.name
+            ))
+
+    def add(self, args):
+        if not args:
+            raise gdb.GdbError('Missing function name')
+        spec, args = args[0], args[1:]
+        condition = None
+        data = None
+        every = 1
+        while args:
+            if len(args) < 2:
+                raise gdb.GdbError('Missing value for {}'.format(args[0]))
+            opt, value, args = args[0], args[1], args[2:]
+            if opt == '--if':
+                condition = compile_expr(value, 'condition')
+            elif opt == '--data':
+                data = compile_expr(value, 'data')
+            elif opt == '--every':
+                try:
+                    every = int(value)
+                except ValueError:
+                    every = 0
+                if every < 1:
+                    raise gdb.GdbError('Invalid sampling period: {}'.format(
+                        value
+                    ))
+            else:
+                raise gdb.GdbError('Invalid option: {}'.format(opt))
+        self.tracer.add_breakpoint(spec, data, condition, every)
+
+    def print_stats(self):
+        for bp in self.tracer.breakpoints:
+            gdb.write('{}: {} hits, {} traced, {} errors, {:.3f}s{}\n'.format(
+                bp.spec, bp.hits, bp.traced, bp.errors, bp.time_spent,
+                ' (1 out of {})'.format(bp.every) if bp.every > 1 else ''
+            ))
@@ -1,9 +1,18 @@
 from functools import wraps
+import json
+import struct
 
 import gdb
 import gdb.types
 
-from gcc.utils import Enum, chain_to_list, is_string
+from gcc.cache import ObjfileCache, StopCache, generation, lookup_type
+from gcc.printers import LocationPrinter
+from gcc.utils import (
+    Enum, field_offset, int_format, is_string, iter_memory_chain,
+    iter_pointer_chain, pointer_size, ptr_to_int, read_int_array,
+    read_memory, read_pointer, read_pointer_array, struct_layout,
+    type_field_offset, unpack_pointer
+)
 
 
 tree_code_class = Enum(gdb.lookup_type('enum tree_code_class'))
@@ -11,18 +20,281 @@ tree_code = Enum(gdb.lookup_type('enum tree_code'))
 tree_node_structure_enum = Enum(
     gdb.lookup_type('enum tree_node_structure_enum')
 )
-tree_contains_struct = gdb.parse_and_eval('tree_contains_struct')
+
+# Integer values for the codes and classes hot paths compare against
+_tcc_declaration = tree_code_class.name_to_value['tcc_declaration']
+_tcc_type = tree_code_class.name_to_value['tcc_type']
+_IDENTIFIER_NODE = tree_code.name_to_value['IDENTIFIER_NODE']
+_TYPE_DECL = tree_code.name_to_value['TYPE_DECL']
+_BLOCK = tree_code.name_to_value['BLOCK']
+_STATEMENT_LIST = tree_code.name_to_value['STATEMENT_LIST']
+_TREE_LIST = tree_code.name_to_value['TREE_LIST']
+_TREE_VEC = tree_code.name_to_value['TREE_VEC']
+_INTEGER_CST = tree_code.name_to_value['INTEGER_CST']
+_TS_TYPED = tree_node_structure_enum.name_to_value['TS_TYPED']
+_tcc_vl_exp = tree_code_class.name_to_value['tcc_vl_exp']
+
+# Classes for tree codes whose subtrees are in the `exp.operands` array
+_operand_classes = frozenset(
+    tree_code_class.name_to_value[name] for name in (
+        'tcc_reference', 'tcc_comparison', 'tcc_unary', 'tcc_binary',
+        'tcc_statement', 'tcc_vl_exp', 'tcc_expression'
+    )
+)
+
+# Values that visitors passed to Tree.walk can return
+WALK_CONTINUE = None
+WALK_SKIP = 1
+WALK_STOP = 2
+
+
+def _read_tree_table(name):
+    """
+    Read one of the constant tables GCC uses to describe tree codes.
+
+    One-dimension tables are returned as lists of integers. For the
+    `tree_contains_struct` matrix, return a (bytearray, row_size) couple.
+    """
+    value = gdb.parse_and_eval(name)
+    row_type = value.type.strip_typedefs().target()
+    if row_type.strip_typedefs().code == gdb.TYPE_CODE_ARRAY:
+        data = read_memory(ptr_to_int(value.address), value.type.sizeof)
+        return (bytearray(data), row_type.sizeof)
+    return read_int_array(value)
+
+
+tree_tables = ObjfileCache('tree_tables', _read_tree_table)
+
+
+def code_class_of(code):
+    """Return the tree_code_class (as an integer) for the `code` integer."""
+    return tree_tables['tree_code_type'][code]
+
+
+def contains_struct(code, tree_node_structure):
+    """
+    Return whether trees with the `code` integer contain the
+    `tree_node_structure` integer.
+    """
+    matrix, row_size = tree_tables['tree_contains_struct']
+    return bool(matrix[code * row_size + tree_node_structure])
+
+
+#
+# Raw accessors for hot paths (breakpoint conditions, ...): they work on tree
+# addresses and do not create gdb.Value or Tree instances.
+#
+
+def read_tree_code(address):
+    """Return the tree code (as an integer) of the tree at `address`."""
+    return struct_layout('tree_base', 'code').decode(
+        address + field_offset('tree', 'base')
+    )['code']
+
+
+def read_name_identifier(address, code=None):
+    """
+    Return the address of the IDENTIFIER_NODE that gives its name to the tree
+    at `address` (0 if it has no name), with the same rules as Tree.name.
+    Raise a ValueError if this kind of tree has no name.
+    """
+    if code is None:
+        code = read_tree_code(address)
+    if code == _IDENTIFIER_NODE:
+        return address
+
+    code_class = code_class_of(code)
+    if code_class == _tcc_declaration:
+        return read_pointer(address + field_offset('tree', 'decl_minimal',
+                                                   'name'))
+    elif code_class == _tcc_type:
+        name = read_pointer(address + field_offset('tree', 'type_common',
+                                                   'name'))
+        if name and read_tree_code(name) == _TYPE_DECL:
+            return read_pointer(name + field_offset('tree', 'decl_minimal',
+                                                    'name'))
+        return name
+    else:
+        raise ValueError('{} have no name'.format(tree_code.from_int(code)))
+
+
+# For each identifier address, (str, len) couple and decoded string. The
+# string a given identifier designates does not change, so entries survive
+# stops: the couple is only there to detect addresses that were reused.
+_identifier_strings = ObjfileCache('identifier_strings', lambda _: {})
+
+
+def read_identifier_string(address):
+    """Return the string for the IDENTIFIER_NODE at `address`."""
+    ht_id = struct_layout('ht_identifier', 'str', 'len').decode(
+        address + field_offset('tree', 'identifier', 'id')
+    )
+    key = (ht_id['str'], ht_id['len'])
+    cache = _identifier_strings[None]
+    entry = cache.get(address)
+    if entry is not None and entry[0] == key:
+        return entry[1]
+
+    # Do not let invalid UTF-8 sequences break breakpoint conditions
+    string = ''
+    if ht_id['len']:
+        data = read_memory(ht_id['str'], ht_id['len'])
+        string = data.decode('utf-8', 'replace')
+    cache[address] = (key, string)
+    return string
+
+
+def _compute_int_cst_layout(_):
+    """
+    Return a (value offset, HOST_WIDE_INT size, length offset) triple for
+    INTEGER_CST nodes.
+
+    Since GCC 5, they hold an array of HOST_WIDE_INT (int_cst.val) whose
+    extended length is in base.u.int_length. Before, they held a double_int
+    (int_cst.int_cst), i.e. a low/high couple: the length offset is None
+    then.
+    """
+    tree_type = lookup_type('tree')
+    hwi_size = lookup_type('HOST_WIDE_INT').sizeof
+    try:
+        return (
+            type_field_offset(tree_type, 'int_cst', 'val'), hwi_size,
+            type_field_offset(tree_type, 'base', 'u', 'int_length',
+                              'extended')
+        )
+    except gdb.error:
+        pass
+    try:
+        return (type_field_offset(tree_type, 'int_cst', 'int_cst', 'low'),
+                hwi_size, None)
+    except gdb.error:
+        raise gdb.error('Cannot find the INTEGER_CST value field')
+
+
+_int_cst_layout = ObjfileCache('int_cst_layout', _compute_int_cst_layout)
+
+
+def read_int_cst(address):
+    """
+    Return the value of the INTEGER_CST at `address`, as a Python integer.
+    This works for both the double_int and the wide_int layouts: in both
+    cases, the value is an array of HOST_WIDE_INT, least significant first,
+    whose last element is signed.
+    """
+    offset, size, length_offset = _int_cst_layout[None]
+    if length_offset is None:
+        count = 2
+    else:
+        count = bytearray(read_memory(address + length_offset, 1))[0]
+    if not count:
+        return 0
+
+    words = struct.unpack(int_format(size, count=count),
+                          read_memory(address + offset, size * count))
+    result = 0
+    for i, word in enumerate(words):
+        result |= word << (8 * size * i)
+    if words[-1] >> (8 * size - 1):
+        result -= 1 << (8 * size * count)
+    return result
+
+
+def read_int_cst_low(address):
+    """
+    Return TREE_INT_CST_LOW (as a signed integer) for the INTEGER_CST at
+    `address`. This works for both the double_int and the wide_int layouts.
+    """
+    offset, size, _ = _int_cst_layout[None]
+    return struct.unpack(int_format(size, signed=True),
+                         read_memory(address + offset, size))[0]
+
+
+def iter_statement_addresses(address):
+    """
+    Yield the addresses of statements in the STATEMENT_LIST at `address`,
+    reading list nodes straight from inferior memory.
+    """
+    node_type = 'tree_statement_list_node'
+    next_offset = field_offset(node_type, 'next')
+    stmt_offset = field_offset(node_type, 'stmt')
+    size = lookup_type(node_type).sizeof
+    head = read_pointer(address + field_offset('tree', 'stmt_list', 'head'))
+    for _, data in iter_memory_chain(head, size, next_offset):
+        yield unpack_pointer(data, stmt_offset)
+
+
+def _compute_tree_vec_length_field(_):
+    tree_type = lookup_type('tree')
+    base_type = tree_type.target().strip_typedefs()['base'].type
+    u_type = base_type.strip_typedefs()['u'].type
+    return (type_field_offset(tree_type, 'base', 'u', 'length'),
+            u_type.strip_typedefs()['length'].type.sizeof)
+
+
+_tree_vec_length_field = ObjfileCache('tree_vec_length_field',
+                                      _compute_tree_vec_length_field)
+
+
+def read_tree_vec_length(address):
+    """Return TREE_VEC_LENGTH for the TREE_VEC at `address`."""
+    offset, size = _tree_vec_length_field[None]
+    return struct.unpack(int_format(size, signed=True),
+                         read_memory(address + offset, size))[0]
+
+
+def read_subtrees(address, code=None):
+    """
+    Return the list of addresses for the non-null subtrees of the tree at
+    `address`, in the same order as GCC's walk_tree: expression operands
+    (the number of operands comes from `tree_code_length`), statements in
+    STATEMENT_LIST, value/chain in TREE_LIST (like walk_tree, TREE_PURPOSE is
+    not walked) and elements in TREE_VEC. Other trees (declarations, types,
+    constants, ...) are leaves.
+    """
+    if code is None:
+        code = read_tree_code(address)
+    code_class = code_class_of(code)
+
+    if code_class in _operand_classes:
+        operands = address + field_offset('tree', 'exp', 'operands')
+        if code_class == _tcc_vl_exp:
+            # The first operand is an INTEGER_CST for the number of operands
+            count = read_int_cst_low(read_pointer(operands))
+        else:
+            count = tree_tables['tree_code_length'][code]
+        result = read_pointer_array(operands, count)
+
+    elif code == _STATEMENT_LIST:
+        result = list(iter_statement_addresses(address))
+
+    elif code == _TREE_LIST:
+        result = [
+            read_pointer(address + field_offset('tree', 'list', 'value')),
+            read_pointer(address + field_offset('tree', 'common', 'chain')),
+        ]
+
+    elif code == _TREE_VEC:
+        result = read_pointer_array(
+            address + field_offset('tree', 'vec', 'a'),
+            read_tree_vec_length(address)
+        )
+
+    else:
+        result = []
+
+    return [a for a in result if a]
 
 
 def check_code_for_primitive(
     primitive, tree,
     tree_node_structures, tree_codes, tree_code_classes
 ):
+    code = tree.code_int
     if (
-        tree.code not in tree_codes
-        and tree.code_class not in tree_code_classes
+        code not in tree_codes
+        and code_class_of(code) not in tree_code_classes
         and not any(
-            tree_contains_struct[tree.code][tree_node_structure]
+            contains_struct(code, tree_node_structure)
             for tree_node_structure in tree_node_structures
         )
     ):
@@ -33,12 +305,14 @@ def check_code_for_primitive(
 
 
 def primitive(*codes):
-    tree_codes = [c for c in codes if c.type == tree_code.gdb_type]
-    tree_code_classes = [
-        c for c in codes if c.type == tree_code_class.gdb_type
-    ]
+    tree_codes = frozenset(
+        int(c) for c in codes if c.type == tree_code.gdb_type
+    )
+    tree_code_classes = frozenset(
+        int(c) for c in codes if c.type == tree_code_class.gdb_type
+    )
     tree_node_structures = [
-        c for c in codes if c.type == tree_node_structure_enum.gdb_type
+        int(c) for c in codes if c.type == tree_node_structure_enum.gdb_type
     ]
     def decorator(func):
         @wraps(func)
@@ -54,29 +328,75 @@ def primitive(*codes):
     return decorator
 
 
+def cached_field(func):
+    """
+    Decorator for Tree methods that decode data from the inferior: the result
+    is saved in the wrapper until the inferior state changes.
+    """
+    name = func.__name__
+
+    @wraps(func)
+    def wrapper(self):
+        if self._generation != generation():
+            self._fields = {}
+            self._generation = generation()
+        try:
+            return self._fields[name]
+        except KeyError:
+            result = func(self)
+            self._fields[name] = result
+            return result
+    return wrapper
+
+
+# Identity map for Tree wrappers, keyed by tree address. It only references
+# wrappers weakly: walking or iterating over large trees does not keep one
+# wrapper per node alive.
+interned_trees = StopCache('trees', weak=True)
+
+
 class Tree(object):
     """Python wrapper around `tree` values to ease data access."""
 
-    def __init__(self, value):
+    def __new__(cls, value):
         """
         Build a wrapper around a `tree` value.
 
         `value` can be either a gdb.Value instance, a string (in which case it
         is converted into a gdb.Value thanks to gdb.parse_and_eval) or an
         integer (in which case it is casted into a tree).
+
+        Wrappers are interned: until the inferior state changes, wrapping the
+        same non-null tree returns the same instance as long as it is still
+        referenced, so that fields it already decoded are reused.
         """
         if is_string(value):
             value = gdb.parse_and_eval(value)
         elif isinstance(value, int):
-            value = gdb.Value(value).cast(gdb.lookup_type('tree'))
+            value = gdb.Value(value).cast(lookup_type('tree'))
+
+        address = (int(value.cast(lookup_type('uintptr_t')))
+                   if value is not None else 0)
+        if address:
+            self = interned_trees.get(address)
+            if self is not None:
+                return self
+
+        self = super(Tree, cls).__new__(cls)
         self.value = value
+        self._address = address
+        self._fields = {}
+        self._generation = generation()
+        if address:
+            interned_trees[address] = self
+        return self
 
     #
     # Common tree primitives
     #
 
     def __nonzero__(self):
-        return bool(self.value)
+        return bool(self._address)
 
     def __bool__(self):
         return self.__nonzero__()
@@ -90,21 +410,44 @@ class Tree(object):
 
     @property
     def address(self):
-        return int(self.value.cast(gdb.lookup_type('uintptr_t')))
+        return self._address
 
     @property
     def code_class(self):
-        return gdb.parse_and_eval(
-            'tree_code_type[{}]'.format(int(self.code))
-        )
+        return tree_code_class.from_int(self.code_class_int)
+
+    @property
+    @cached_field
+    def code_class_int(self):
+        return code_class_of(self.code_int)
 
     @property
     def code(self):
-        return self.struct['base']['code'].cast(tree_code.gdb_type)
+        return tree_code.from_int(self.code_int)
+
+    @property
+    @cached_field
+    def code_int(self):
+        return read_tree_code(self._address)
 
     def get_operand(self, i):
         return Tree(self.struct['exp']['operands'][i])
 
+    @staticmethod
+    def iter_chain(start, *next_path):
+        """
+        Yield trees in the chain starting at the `start` tree and following
+        the `next_path` field (for instance: 'common', 'chain').
+
+        This reads next-pointers straight from inferior memory, so no
+        gdb.Value is created for intermediate nodes, and the chain is read
+        only as far as the caller consumes it.
+        """
+        for address in iter_pointer_chain(
+            start.address, field_offset('tree', *next_path)
+        ):
+            yield Tree(address)
+
     #
     # Specialized primitives
     #
@@ -115,23 +458,27 @@ class Tree(object):
         return self.struct['identifier']['id']['str'].string()
 
     @property
+    @cached_field
     def name(self):
+        code_class = self.code_class_int
+
         # Declaration nodes are supposed to have either no name or an
         # IDENTIFIER_NODE.
-        if self.code_class == tree_code_class.tcc_declaration:
+        if code_class == _tcc_declaration:
             if not self.decl_name:
                 return None
             return self.decl_name.identifier_string
 
         # For their name, type nodes are allowed to have either no name, a
         # TYPE_DECL node or an IDENTIFIER_NODE.
-        elif self.code_class == gdb.parse_and_eval('tcc_type'):
-            if not self.type_name:
+        elif code_class == _tcc_type:
+            type_name = self.type_name
+            if not type_name:
                 return None
-            elif self.type_name.code == tree_code.TYPE_DECL:
-                return self.type_name.decl_name.identifier_string
+            elif type_name.code_int == _TYPE_DECL:
+                return type_name.decl_name.identifier_string
             else:
-                return self.type_name.identifier_string
+                return type_name.identifier_string
 
         else:
             raise ValueError('{} have no name'.format(self.code))
@@ -139,9 +486,10 @@ class Tree(object):
     @property
     @primitive(tree_code_class.tcc_type, tree_code_class.tcc_declaration)
     def context(self):
-        if self.code_class == tree_code_class.tcc_type:
+        code_class = self.code_class_int
+        if code_class == _tcc_type:
             return self.get_tree_field('type_common', 'context')
-        elif self.code_class == tree_code_class.tcc_declaration:
+        elif code_class == _tcc_declaration:
             return self.get_tree_field('decl_minimal', 'context')
         else:
             raise ValueError('{} have no context'.format(self.code))
@@ -164,8 +512,12 @@ class Tree(object):
 
     @property
     @primitive(tree_code_class.tcc_declaration)
+    def iter_decl_chain(self):
+        return Tree.iter_chain(self, 'common', 'chain')
+
+    @property
     def decl_to_chain_list(self):
-        return chain_to_list(self, lambda x: x.chain)
+        return list(self.iter_decl_chain)
 
     @property
     @primitive(tree_code.TREE_LIST)
@@ -182,7 +534,7 @@ class Tree(object):
             return 'NULL_TREE'
 
         def get_suffix():
-            if self.code == tree_code.IDENTIFIER_NODE:
+            if self.code_int == _IDENTIFIER_NODE:
                 return self.identifier_string
 
             try: return str(self.int_cst)
@@ -201,19 +553,21 @@ class Tree(object):
     # INTEGER_CST
 
     @property
+    @cached_field
     @primitive(tree_code.INTEGER_CST)
     def int_cst(self):
-        double_struct = self.struct['int_cst']['int_cst']
-        low = double_struct['low']
-        high = double_struct['high']
-        return int(high) << (8 * low.type.sizeof) | int(low)
+        return read_int_cst(self._address)
 
     # BIND_EXPR
 
     @property
     @primitive(tree_code.BIND_EXPR)
+    def iter_bind_vars(self):
+        return Tree.iter_chain(self.get_operand(0), 'common', 'chain')
+
+    @property
     def bind_vars(self):
-        return chain_to_list(self.get_operand(0), lambda x: x.chain)
+        return list(self.iter_bind_vars)
 
     @property
     @primitive(tree_code.BIND_EXPR)
@@ -244,34 +598,57 @@ class Tree(object):
 
     @property
     @primitive(tree_code.BLOCK)
-    def block_vars(self):
-        return chain_to_list(
+    def iter_block_vars(self):
+        return Tree.iter_chain(
             self.get_tree_field('block', 'vars'),
-            lambda x: x.chain
+            'common', 'chain'
         )
 
+    @property
+    def block_vars(self):
+        return list(self.iter_block_vars)
+
     @property
     @primitive(tree_code.BLOCK)
+    def iter_block_all_vars(self):
+        """
+        Yield variables in "self" and in all its subblocks (depth-first,
+        parents first).
+        """
+        return self._iter_block_all_vars()
+
+    def _iter_block_all_vars(self):
+        # Use an explicit stack of subblock iterators rather than recursion
+        # so that deeply nested blocks cannot hit the recursion limit.
+        stack = [iter([self])]
+        while stack:
+            for block in stack[-1]:
+                for var in block.iter_block_vars:
+                    yield var
+                stack.append(block.iter_block_subblocks)
+                break
+            else:
+                stack.pop()
+
+    @property
     def block_all_vars(self):
         """
         Return the list of varibles in "self" and in all its subblocks.
         """
-        result = []
-        def traverse(b):
-            result.extend(b.block_vars)
-            for sb in b.block_subblocks:
-                traverse(sb)
-        traverse(self)
-        return result
+        return list(self.iter_block_all_vars)
 
     @property
     @primitive(tree_code.BLOCK)
-    def block_subblocks(self):
-        return chain_to_list(
+    def iter_block_subblocks(self):
+        return Tree.iter_chain(
             self.get_tree_field('block', 'subblocks'),
-            lambda x: x.block_chain
+            'block', 'chain'
         )
 
+    @property
+    def block_subblocks(self):
+        return list(self.iter_block_subblocks)
+
     @property
     @primitive(tree_code.BLOCK)
     def block_superblock(self):
@@ -284,21 +661,25 @@ class Tree(object):
 
     def block_dump(self, prefix=''):
         print('{}block {}'.format(prefix, self))
-        for var in self.block_vars:
+        for var in self.iter_block_vars:
             print('{}  var {}'.format(prefix, var))
-        for sb in self.block_subblocks:
+        for sb in self.iter_block_subblocks:
             sb.block_dump(prefix + '  ')
 
     # TYPE'S
 
     @property
     @primitive(tree_code_class.tcc_type)
-    def type_variants(self):
-        return chain_to_list(
+    def iter_type_variants(self):
+        return Tree.iter_chain(
             self.type_main_variant,
-            lambda x: self.get_tree_field('type_common', 'next_variant')
+            'type_common', 'next_variant'
         )
 
+    @property
+    def type_variants(self):
+        return list(self.iter_type_variants)
+
     @property
     @primitive(tree_code_class.tcc_type)
     def type_main_variant(self):
@@ -324,37 +705,49 @@ class Tree(object):
     def type_stub_decl(self):
         return self.get_tree_field('common', 'chain')
 
-    def _get_values_chain(self):
-        return chain_to_list(
+    def _iter_values_chain(self):
+        for x in Tree.iter_chain(
             self.get_tree_field('type_non_common', 'values'),
-            lambda x: x.list_chain,
-            lambda x: x.list_value
-        )
+            'common', 'chain'
+        ):
+            yield x.list_value
 
     @property
     @primitive(tree_code.RECORD_TYPE, tree_code.UNION_TYPE,
                tree_code.QUAL_UNION_TYPE)
-    def type_fields(self):
-        return chain_to_list(
+    def iter_type_fields(self):
+        return Tree.iter_chain(
             self.get_tree_field('type_non_common', 'values'),
-            lambda x: x.chain
+            'common', 'chain'
         )
 
+    @property
+    def type_fields(self):
+        return list(self.iter_type_fields)
+
     @property
     @primitive(tree_code.FUNCTION_TYPE, tree_code.METHOD_TYPE)
+    def iter_arg_types(self):
+        return self._iter_values_chain()
+
+    @property
     def arg_types(self):
-        return self._get_values_chain()
+        return list(self.iter_arg_types)
 
     @property
     @primitive(tree_code.RECORD_TYPE,
                tree_code.UNION_TYPE,
                tree_code.QUAL_UNION_TYPE)
-    def type_methods(self):
-        return chain_to_list(
+    def iter_type_methods(self):
+        return Tree.iter_chain(
             self.get_tree_field('type_non_common', 'maxval'),
-            lambda x: x.chain
+            'common', 'chain'
         )
 
+    @property
+    def type_methods(self):
+        return list(self.iter_type_methods)
+
     @property
     @primitive(tree_code_class.tcc_type)
     def type_descriptive_type(self):
@@ -392,12 +785,16 @@ class Tree(object):
 
     @property
     @primitive(tree_code.FUNCTION_DECL)
-    def arguments(self):
-        return chain_to_list(
+    def iter_arguments(self):
+        return Tree.iter_chain(
             self.get_tree_field('function_decl', 'arguments'),
-            lambda x: x.chain
+            'common', 'chain'
         )
 
+    @property
+    def arguments(self):
+        return list(self.iter_arguments)
+
     @property
     @primitive(tree_code.FUNCTION_DECL)
     def saved_tree(self):
@@ -407,12 +804,315 @@ class Tree(object):
 
     @property
     @primitive(tree_code.STATEMENT_LIST)
+    def iter_statements(self):
+        return self._iter_statements()
+
+    def _iter_statements(self):
+        for address in iter_statement_addresses(self._address):
+            yield Tree(address)
+
+    @property
     def statements(self):
-        return chain_to_list(
-            self.struct['stmt_list']['head'],
-            lambda x: x['next'],
-            lambda x: Tree(x['stmt'])
+        return list(self.iter_statements)
+
+    # Walking
+
+    def walk(self, visitor, max_nodes=None, codes=None):
+        """
+        Walk the tree rooted at "self" depth-first (parents first, subtrees
+        in the order read_subtrees returns them).
+
+        `visitor(tree, depth)` is called for each tree: it can return
+        WALK_SKIP not to walk the subtrees of `tree`, or WALK_STOP to end the
+        walk. Trees are visited at most once, even when shared, so walking
+        DAGs terminates. If `codes` is provided (tree codes as gdb.Value,
+        integers or names), only trees with these codes are passed to the
+        visitor, the others are still walked through. Stop after visiting
+        `max_nodes` trees, if provided.
+
+        Return the number of trees visited, i.e. passed to the visitor (trees
+        that are only walked through do not count, for `max_nodes` neither).
+        """
+        if codes is not None:
+            codes = frozenset(
+                tree_code.name_to_value[c] if is_string(c) else int(c)
+                for c in codes
+            )
+        if not self:
+            return 0
+
+        visited = set([self.address])
+        stack = [(self.address, 0)]
+        count = 0
+        while stack:
+            address, depth = stack.pop()
+            code = read_tree_code(address)
+
+            if codes is None or code in codes:
+                if max_nodes is not None and count >= max_nodes:
+                    break
+                count += 1
+                action = visitor(Tree(address), depth)
+                if action == WALK_STOP:
+                    break
+                elif action == WALK_SKIP:
+                    continue
+
+            subtrees = [a for a in read_subtrees(address, code)
+                        if a not in visited]
+            visited.update(subtrees)
+            stack.extend((a, depth + 1) for a in reversed(subtrees))
+        return count
+
+    # Lookups
+
+    @staticmethod
+    def lookup_name(name):
+        """
+        Return the list of trees named `name`: declarations in the current
+        function first, then the IDENTIFIER_NODE for `name`, if any.
+        """
+        return NameIndex.get().lookup(name)
+
+
+def read_identifier_addresses():
+    """
+    Yield the addresses of all IDENTIFIER_NODEs in the identifier hash table
+    (`ident_hash`). The slots array is fetched with one memory read.
+    """
+    table = ptr_to_int(gdb.parse_and_eval('ident_hash'))
+    if not table:
+        return
+    layout = struct_layout('cpp_hash_table', 'entries', 'nslots')
+    fields = layout.decode(table)
+
+    # Slots contain either NULL, HT_DELETED (-1) or a pointer to the
+    # ht_identifier embedded in a tree_identifier.
+    deleted = (1 << (8 * pointer_size())) - 1
+    id_offset = field_offset('tree', 'identifier', 'id')
+    for entry in read_pointer_array(fields['entries'], fields['nslots']):
+        if entry and entry != deleted:
+            yield entry - id_offset
+
+
+class NameIndex(object):
+    """
+    Lookup tables from names to trees: `identifiers` maps names to the
+    address of their IDENTIFIER_NODE, and `decls` maps names to the list of
+    addresses for the current function declaration, its arguments and the
+    variables in its BLOCK tree.
+    """
+
+    def __init__(self):
+        self.identifiers = {}
+        for address in read_identifier_addresses():
+            # Skip malformed entries rather than giving up on the index
+            try:
+                name = read_identifier_string(address)
+            except (gdb.error, ValueError):
+                continue
+            self.identifiers[name] = address
+
+        self.decls = {}
+        fndecl = Tree('current_function_decl')
+        if fndecl:
+            decls = [fndecl]
+            decls.extend(fndecl.iter_arguments)
+            block = fndecl.decl_initial
+            if block and block.code_int == _BLOCK:
+                decls.extend(block.iter_block_all_vars)
+            for decl in decls:
+                name = decl.name
+                if name is not None:
+                    self.decls.setdefault(name, []).append(decl.address)
+
+    @classmethod
+    def get(cls):
+        """Return the name index, built at most once per stop."""
+        return name_indexes[None]
+
+    def lookup(self, name):
+        result = [Tree(address) for address in self.decls.get(name, [])]
+        identifier = self.identifiers.get(name)
+        if identifier:
+            result.append(Tree(identifier))
+        return result
+
+
+name_indexes = StopCache('tree_name_indexes', lambda _: NameIndex())
+
+
+class TreeDumper(object):
+    """
+    Visitor for Tree.walk that writes one line per tree to `out` as soon as
+    it is visited: indented text, or JSON objects if `as_json` is true.
+
+    Each line gives the tree code, address, name, type, INTEGER_CST value
+    (TREE_INT_CST_LOW) and location, when relevant. Locations are raw
+    location_t integers unless `locations` is true, in which case they are
+    expanded with inferior calls (much slower).
+
+    Memory usage does not depend on the size of the output, except for the
+    set of visited addresses Tree.walk needs (one integer per tree).
+    """
+
+    # Number of trees between two progress messages
+    progress_period = 10000
+
+    # Maximum number of type descriptions to keep
+    max_type_descriptions = 4096
+
+    def __init__(self, out, as_json=False, locations=False):
+        self.out = out
+        self.as_json = as_json
+        self.locations = locations
+        self.count = 0
+        self.type_descriptions = {}
+
+    def describe_type(self, address):
+        try:
+            return self.type_descriptions[address]
+        except KeyError:
+            pass
+        code = read_tree_code(address)
+        result = tree_code.value_to_name.get(code, str(code))
+
+        # Front ends sometimes use TREE_TYPE for nodes that are neither types
+        # nor declarations: just give their code.
+        try:
+            identifier = read_name_identifier(address, code)
+        except ValueError:
+            identifier = 0
+        if identifier:
+            result += ' ' + read_identifier_string(identifier)
+
+        if len(self.type_descriptions) >= self.max_type_descriptions:
+            self.type_descriptions.clear()
+        self.type_descriptions[address] = result
+        return result
+
+    def describe(self, tree, depth):
+        address = tree.address
+        code = tree.code_int
+        code_class = code_class_of(code)
+        result = {
+            'depth': depth,
+            'address': address,
+            'code': tree_code.value_to_name.get(code, str(code)),
+        }
+
+        if code_class in (_tcc_declaration, _tcc_type) or (
+            code == _IDENTIFIER_NODE
+        ):
+            identifier = read_name_identifier(address, code)
+            if identifier:
+                result['name'] = read_identifier_string(identifier)
+
+        if contains_struct(code, _TS_TYPED):
+            typ = read_pointer(address + field_offset('tree', 'typed',
+                                                      'type'))
+            if typ:
+                result['type'] = self.describe_type(typ)
+
+        if code == _INTEGER_CST:
+            try:
+                result['value'] = read_int_cst_low(address)
+            except gdb.error:
+                pass
+
+        locus = 0
+        if code_class in _operand_classes:
+            locus = int(tree.struct['exp']['locus'])
+        elif code_class == _tcc_declaration:
+            locus = int(tree.struct['decl_minimal']['locus'])
+        if locus:
+            result['location'] = (LocationPrinter(locus).to_string()
+                                  if self.locations else locus)
+
+        return result
+
+    def format(self, record):
+        result = '{}{} {:#x}'.format(
+            '  ' * record['depth'], record['code'], record['address']
         )
+        if 'name' in record:
+            result += ' ' + record['name']
+        for key in ('type', 'value', 'location'):
+            if key in record:
+                result += ' {}={}'.format(key, record[key])
+        return result
+
+    def __call__(self, tree, depth):
+        record = self.describe(tree, depth)
+        self.out.write('{}\n'.format(
+            json.dumps(record) if self.as_json else self.format(record)
+        ))
+
+        self.count += 1
+        if self.count % self.progress_period == 0:
+            gdb.write('{} trees dumped...\n'.format(self.count))
+            gdb.flush()
+
+
+def dump_tree(tree, filename, as_json=False, locations=False,
+              max_nodes=None):
+    """
+    Dump the tree rooted at `tree` to `filename` (see TreeDumper). Return the
+    number of trees dumped.
+    """
+    with open(filename, 'w') as f:
+        dumper = TreeDumper(f, as_json, locations)
+        tree.walk(dumper, max_nodes)
+    return dumper.count
+
+
+class DumpTreeCommand(gdb.Command):
+    """
+    Dump a GENERIC tree to a file.
+
+    Usage: gcc-dump-tree [--json] [--locations] [--max-nodes N] EXPR FILE
+
+    Walk the tree EXPR evaluates to (for instance:
+    "current_function_decl->decl_non_common.saved_tree") and write one line
+    per subtree, indented text by default or JSON objects with --json.
+    Lines are written as trees are visited. --locations expands locations
+    to file:line:column, which requires inferior calls.
+    """
+
+    def __init__(self, name='gcc-dump-tree'):
+        super(DumpTreeCommand, self).__init__(
+            name, gdb.COMMAND_DATA, gdb.COMPLETE_EXPRESSION
+        )
+
+    def invoke(self, arg, from_tty):
+        usage = ('Usage: gcc-dump-tree [--json] [--locations]'
+                 ' [--max-nodes N] EXPR FILE')
+        argv = gdb.string_to_argv(arg)
+        kwargs = {}
+        positional = []
+        while argv:
+            a = argv.pop(0)
+            if a == '--json':
+                kwargs['as_json'] = True
+            elif a == '--locations':
+                kwargs['locations'] = True
+            elif a == '--max-nodes' and argv:
+                try:
+                    kwargs['max_nodes'] = int(argv.pop(0))
+                except ValueError:
+                    raise gdb.GdbError(usage)
+            elif a.startswith('--'):
+                raise gdb.GdbError('Invalid option: {}'.format(a))
+            else:
+                positional.append(a)
+        if len(positional) != 2:
+            raise gdb.GdbError(usage)
+
+        tree = Tree(positional[0])
+        if not tree:
+            raise gdb.GdbError('Cannot dump NULL_TREE')
+        count = dump_tree(tree, positional[1], **kwargs)
+        gdb.write('Wrote {} trees to {}\n'.format(count, positional[1]))
 
 
 class TreePrinter(object):
@@ -1,7 +1,10 @@
+import struct
 import sys
 
 import gdb
 
+from gcc.cache import ObjfileCache, lookup_type
+
 
 def iter_frames(start=None):
     """
@@ -30,6 +33,240 @@ def chain_to_list(start, next_func, get_elt_func=None):
     return result
 
 
+def type_field_offset(typ, *path):
+    """
+    Return the byte offset of the `path` field (a sequence of nested field
+    names) in the `typ` gdb.Type. If `typ` is a pointer type, consider its
+    target type instead.
+    """
+    typ = typ.strip_typedefs()
+    if typ.code == gdb.TYPE_CODE_PTR:
+        typ = typ.target().strip_typedefs()
+    offset = 0
+    for name in path:
+        for field in typ.fields():
+            if field.name == name:
+                break
+        else:
+            raise gdb.error('No field {} in {}'.format(name, typ))
+        offset += field.bitpos // 8
+        typ = field.type.strip_typedefs()
+    return offset
+
+
+def _compute_field_offset(key):
+    type_name, path = key
+    return type_field_offset(lookup_type(type_name), *path)
+
+
+_field_offsets = ObjfileCache('field_offsets', _compute_field_offset)
+
+
+def field_offset(type_name, *path):
+    """
+    Return the byte offset of the `path` field (a sequence of nested field
+    names) in the `type_name` type. If `type_name` designates a pointer type,
+    consider its target type instead.
+    """
+    return _field_offsets[(type_name, path)]
+
+
+def pointer_size():
+    return lookup_type('void').pointer().sizeof
+
+
+def read_pointer(address):
+    """Read the target pointer stored at `address` in inferior memory."""
+    size = pointer_size()
+    return struct.unpack(
+        int_format(size),
+        gdb.selected_inferior().read_memory(address, size)
+    )[0]
+
+
+def unpack_pointer(data, offset=0):
+    """Decode the target pointer stored at `offset` in `data`."""
+    size = pointer_size()
+    return struct.unpack_from(int_format(size), data, offset)[0]
+
+
+def iter_memory_chain(address, size, next_offset, sentinel=None):
+    """
+    Follow a linked chain of nodes reading inferior memory directly.
+
+    Starting at the `address` node, read `size` bytes for each node (this
+    must include the next-pointer, which lies at `next_offset`) and yield
+    (address, data) couples. Stop on NULL pointers or when the next-pointer
+    is `sentinel` (for circular lists, pass the first node).
+    """
+    inferior = gdb.selected_inferior()
+    ptr_fmt = int_format(pointer_size())
+    while address:
+        data = inferior.read_memory(address, size).tobytes()
+        yield (address, data)
+        address = struct.unpack_from(ptr_fmt, data, next_offset)[0]
+        if address == sentinel:
+            return
+
+
+def iter_pointer_chain(address, next_offset, sentinel=None):
+    """
+    Yield the addresses of nodes in the chain starting at `address` whose
+    next-pointer lies at `next_offset`. See `iter_memory_chain`.
+    """
+    size = pointer_size()
+    inferior = gdb.selected_inferior()
+    ptr_fmt = int_format(size)
+    while address:
+        yield address
+        address = struct.unpack(
+            ptr_fmt, inferior.read_memory(address + next_offset, size)
+        )[0]
+        if address == sentinel:
+            return
+
+
+class StructLayout(object):
+    """
+    Decoder for some scalar fields (integers, enumerations, pointers, bit
+    fields and arrays of them) of a structure type, from raw memory.
+
+    Decoding bit fields from raw memory is only implemented for
+    little-endian targets: on big-endian ones, fall back to gdb.Value field
+    accesses.
+    """
+
+    def __init__(self, type_name, field_names):
+        typ = lookup_type(type_name).strip_typedefs()
+        if typ.code == gdb.TYPE_CODE_PTR:
+            typ = typ.target().strip_typedefs()
+        self.type = typ
+        self.size = typ.sizeof
+        self.raw = _byte_order[None] == '<'
+        self.fields = []
+        for name in field_names:
+            field = typ[name]
+            field_type = field.type.strip_typedefs()
+            if field_type.code == gdb.TYPE_CODE_ARRAY:
+                elt_type = field_type.target().strip_typedefs()
+                count = field_type.sizeof // elt_type.sizeof
+            else:
+                elt_type = field_type
+                count = None
+            self.fields.append((
+                name, field.bitpos, field.bitsize, elt_type.sizeof, count,
+                self._is_signed(elt_type)
+            ))
+
+    @staticmethod
+    def _is_signed(typ):
+        if typ.code != gdb.TYPE_CODE_INT:
+            return False
+        is_signed = getattr(typ, 'is_signed', None)
+        if is_signed is not None:
+            return is_signed
+        return not str(typ).startswith('unsigned')
+
+    def _decode_raw(self, data):
+        result = {}
+        for name, bitpos, bitsize, size, count, signed in self.fields:
+            if count is not None:
+                result[name] = struct.unpack_from(
+                    int_format(size, signed, count), data, bitpos // 8
+                )
+            elif not bitsize:
+                result[name] = struct.unpack_from(
+                    int_format(size, signed), data, bitpos // 8
+                )[0]
+            else:
+                first = bitpos // 8
+                last = (bitpos + bitsize + 7) // 8
+                word = 0
+                for i, byte in enumerate(bytearray(data[first:last])):
+                    word |= byte << (8 * i)
+                value = (word >> (bitpos % 8)) & ((1 << bitsize) - 1)
+                if signed and value >> (bitsize - 1):
+                    value -= 1 << bitsize
+                result[name] = value
+        return result
+
+    def _decode_value(self, address):
+        value = gdb.Value(address).cast(self.type.pointer()).dereference()
+        result = {}
+        for name, _, _, _, count, _ in self.fields:
+            field = value[name]
+            if count is not None:
+                result[name] = tuple(
+                    int(field[i].cast(lookup_type('uintptr_t'))
+                        if field[i].type.strip_typedefs().code ==
+                        gdb.TYPE_CODE_PTR else field[i])
+                    for i in range(count)
+                )
+            elif field.type.strip_typedefs().code == gdb.TYPE_CODE_PTR:
+                result[name] = int(field.cast(lookup_type('uintptr_t')))
+            else:
+                result[name] = int(field)
+        return result
+
+    def decode(self, address):
+        """
+        Read the structure at `address` and return a dict that maps field
+        names to integers (tuples of integers for arrays).
+        """
+        if self.raw:
+            return self._decode_raw(read_memory(address, self.size))
+        return self._decode_value(address)
+
+
+_struct_layouts = ObjfileCache(
+    'struct_layouts', lambda key: StructLayout(key[0], key[1])
+)
+
+
+def struct_layout(type_name, *field_names):
+    """Return the (cached) StructLayout for these fields of `type_name`."""
+    return _struct_layouts[(type_name, field_names)]
+
+
+def read_pointer_array(address, count):
+    """
+    Read an array of `count` target pointers at `address` with one memory
+    read and return them as a list of integers.
+    """
+    if not count:
+        return []
+    size = pointer_size()
+    data = read_memory(address, count * size)
+    return list(struct.unpack(int_format(size, count=count), data))
+
+
+def read_vec_pointers(vec):
+    """
+    Read the elements of `vec`, a gdb.Value for a GCC `vec<T *, ...> *`, with
+    a single memory read for the whole array. Return them as a list of
+    addresses.
+    """
+    address = ptr_to_int(vec)
+    if not address:
+        return []
+    vec_type = vec.type.strip_typedefs().target().strip_typedefs()
+    num_type = vec_type['m_vecpfx'].type.strip_typedefs()['m_num'].type
+    num = struct.unpack(
+        int_format(num_type.sizeof),
+        read_memory(
+            address + type_field_offset(vec_type, 'm_vecpfx', 'm_num'),
+            num_type.sizeof
+        )
+    )[0]
+    if not num:
+        return []
+    size = pointer_size()
+    data = read_memory(
+        address + type_field_offset(vec_type, 'm_vecdata'), num * size
+    )
+    return list(struct.unpack(int_format(size, count=num), data))
+
+
 def fmt_list(lst):
     """Format a list to a string with one element per line."""
     return '\n'.join(
@@ -39,7 +276,44 @@ def fmt_list(lst):
 
 
 def ptr_to_int(value):
-    return int(value.cast(gdb.lookup_type('intptr_t')))
+    return int(value.cast(lookup_type('intptr_t')))
+
+
+def _compute_byte_order(_):
+    endian = gdb.execute('show endian', to_string=True)
+    return '>' if 'big endian' in endian else '<'
+
+
+_byte_order = ObjfileCache('byte_order', _compute_byte_order)
+
+_int_formats = {1: 'b', 2: 'h', 4: 'i', 8: 'q'}
+
+
+def int_format(size, signed=False, count=1):
+    """
+    Return the `struct` format string to decode `count` target integers of
+    `size` bytes.
+    """
+    fmt = _int_formats[size]
+    return '{}{}{}'.format(
+        _byte_order[None], count, fmt if signed else fmt.upper()
+    )
+
+
+def read_memory(address, size):
+    """Read `size` bytes of inferior memory starting at `address`."""
+    return gdb.selected_inferior().read_memory(address, size).tobytes()
+
+
+def read_int_array(value, signed=False):
+    """
+    Read the whole `value` array (a gdb.Value) of integers/enumerations in a
+    single memory read and return it as a list of integers.
+    """
+    elt_size = value.type.strip_typedefs().target().sizeof
+    count = value.type.sizeof // elt_size
+    data = read_memory(ptr_to_int(value.address), value.type.sizeof)
+    return list(struct.unpack(int_format(elt_size, signed, count), data))
 
 
 class Enum(object):
@@ -50,9 +324,31 @@ class Enum(object):
             value: name
             for name, value in self.name_to_value.items()
         }
+        self._values = {}
+
+    def from_int(self, value):
+        """Return the gdb.Value for the `value` enumerator."""
+        try:
+            return self._values[value]
+        except KeyError:
+            result = gdb.Value(value).cast(self.gdb_type)
+            self._values[value] = result
+            return result
 
     def __getattr__(self, name):
-        return gdb.Value(self.name_to_value[name]).cast(self.gdb_type)
+        try:
+            value = self.name_to_value[name]
+        except KeyError:
+            raise AttributeError(name)
+        return self.from_int(value)
+
+
+_enums = ObjfileCache('enums', lambda name: Enum(lookup_type(name)))
+
+
+def lookup_enum(name):
+    """Return the (cached) Enum instance for the `name` enumeration type."""
+    return _enums[name]
 
 
 def is_string(value):